@@ -45,8 +45,11 @@ import os
 import socket
 import select
 
+# Import the utilities helper module
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import utilities
+
 from kortex_api.autogen.client_stubs.BaseClientRpc import BaseClient
-from kortex_api.autogen.client_stubs.DeviceManagerClientRpc import DeviceManagerClient
 from kortex_api.autogen.client_stubs.InterconnectConfigClientRpc import InterconnectConfigClient
 
 from kortex_api.autogen.messages import Base_pb2
@@ -62,7 +65,6 @@ class UARTBridge:
 
         # Create services
         self.base = BaseClient(self.router)
-        self.device_manager =  DeviceManagerClient(self.router)
         self.interconnect_config = InterconnectConfigClient(self.router)
 
         self.interconnect_device_id = self.GetDeviceIdFromDevType(Common_pb2.INTERCONNECT, 0)
@@ -71,16 +73,11 @@ class UARTBridge:
             sys.exit(0)
 
     def GetDeviceIdFromDevType(self, device_type, device_index = 0):
-        devices = self.device_manager.ReadAllDevices()
-
-        current_index = 0
-        for device in devices.device_handle:
-            if device.device_type == device_type:
-                if current_index == device_index:
-                    print ("Found the Interconnect on device identifier {}".format(device.device_identifier))
-                    return device.device_identifier
-                current_index += 1
-        return None
+        # The device list is read once per session
+        device_id = utilities.device_metadata(self.router).device_id(device_type, device_index)
+        if device_id is not None:
+            print ("Found the Interconnect on device identifier {}".format(device_id))
+        return device_id
 
     def Configure(self, port_id, enabled, speed, word_length, stop_bits, parity):
         '''
@@ -167,10 +164,7 @@ class UARTBridge:
 
 def main():
 
-    # Import the utilities helper module
     import argparse
-    sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
-    import utilities
 
     # Parse arguments
     parser = argparse.ArgumentParser()
@@ -59,7 +59,10 @@ import sys
 import os
 import time
 
-from kortex_api.autogen.client_stubs.DeviceManagerClientRpc import DeviceManagerClient
+# Import the utilities helper module
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import utilities
+
 from kortex_api.autogen.client_stubs.InterconnectConfigClientRpc import InterconnectConfigClient
 
 from kortex_api.autogen.messages import Common_pb2
@@ -81,7 +84,6 @@ class GpioBridge:
         
         self.router = router
 
-        self.device_manager = DeviceManagerClient(self.router)
         self.interconnect_config = InterconnectConfigClient(self.router)
         
         self.interconnect_device_id = self.GetDeviceIdFromDevType(Common_pb2.INTERCONNECT, 0)
@@ -90,16 +92,11 @@ class GpioBridge:
             sys.exit(0)
 
     def GetDeviceIdFromDevType(self, device_type, device_index = 0):
-        devices = self.device_manager.ReadAllDevices()
-
-        current_index = 0
-        for device in devices.device_handle:
-            if device.device_type == device_type:
-                if current_index == device_index:
-                    print ("Found the Interconnect on device identifier {}".format(device.device_identifier))
-                    return device.device_identifier
-                current_index += 1
-        return None
+        # The device list is read once per session
+        device_id = utilities.device_metadata(self.router).device_id(device_type, device_index)
+        if device_id is not None:
+            print ("Found the Interconnect on device identifier {}".format(device_id))
+        return device_id
 
     def InitGpioInputsAndOutputs(self):
         gpio_config                  = InterconnectConfig_pb2.GPIOConfiguration()
@@ -189,10 +186,7 @@ class GpioBridge:
 
 def main():
 
-    # Import the utilities helper module
     import argparse
-    sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
-    import utilities
 
     # Parse arguments
     parser = argparse.ArgumentParser()
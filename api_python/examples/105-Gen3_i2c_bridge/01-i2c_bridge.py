@@ -54,7 +54,10 @@ import sys
 import os
 import time
 
-from kortex_api.autogen.client_stubs.DeviceManagerClientRpc import DeviceManagerClient
+# Import the utilities helper module
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import utilities
+
 from kortex_api.autogen.client_stubs.InterconnectConfigClientRpc import InterconnectConfigClient
 
 from kortex_api.autogen.messages import Common_pb2
@@ -70,9 +73,8 @@ class I2CBridge:
         '''
         self.router = router
         
-        # Create device manager client. Device manager is used get a list of devices present in the arm. In this example
-        # we use device manager to determine the device ID associated with the interconnect.
-        self.device_manager =  DeviceManagerClient(self.router)
+        # The list of devices present in the arm, read once per session through the device metadata of utilities,
+        # is used to determine the device ID associated with the interconnect.
 
         # Create interconnect configuration client. This client is used to perform I2C bus configuration and I2C bus actions.
         self.interconnect_config = InterconnectConfigClient(self.router)
@@ -93,16 +95,11 @@ class I2CBridge:
     Index argument correspond to the position of the device (i.e.: 0 being the first,1 the second, etc.)
     """
     def GetDeviceIdFromDevType(self, device_type, device_index = 0):
-        devices = self.device_manager.ReadAllDevices()
-
-        current_index = 0
-        for device in devices.device_handle:
-            if device.device_type == device_type:
-                if current_index == device_index:
-                    print ("Found the Interconnect on device identifier {}".format(device.device_identifier))
-                    return device.device_identifier
-                current_index += 1
-        return None
+        # The device list is read once per session
+        device_id = utilities.device_metadata(self.router).device_id(device_type, device_index)
+        if device_id is not None:
+            print ("Found the Interconnect on device identifier {}".format(device_id))
+        return device_id
 
     """
     WriteValue(device_address, data, timeout_ms)
@@ -176,10 +173,7 @@ class I2CBridge:
 
 def main():
     
-    # Import the utilities helper module
     import argparse
-    sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
-    import utilities
 
     # Parse arguments
     parser = argparse.ArgumentParser()
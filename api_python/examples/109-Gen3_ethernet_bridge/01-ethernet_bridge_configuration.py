@@ -16,16 +16,20 @@ import sys
 import os
 import time
 
-from kortex_api.autogen.client_stubs.DeviceManagerClientRpc import DeviceManagerClient
+# Import the utilities helper module
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import utilities
+
 from kortex_api.autogen.client_stubs.InterconnectConfigClientRpc import InterconnectConfigClient
 from kortex_api.autogen.messages import Session_pb2, Base_pb2, Common_pb2, InterconnectConfig_pb2, DeviceManager_pb2
 
 
 class EthernetBridgeConfigurationExample:
     def __init__(self, router):
+        self.router = router
+
         # Create required services        
         self.interconnect_config = InterconnectConfigClient(router)
-        self.device_manager = DeviceManagerClient(router)
         
         self.interconnect_device_id = self.GetDeviceIdFromDevType(Common_pb2.INTERCONNECT, 0)
         if (self.interconnect_device_id is None):
@@ -33,16 +37,11 @@ class EthernetBridgeConfigurationExample:
             sys.exit(0)
 
     def GetDeviceIdFromDevType(self, device_type, device_index = 0):
-        devices = self.device_manager.ReadAllDevices()
-
-        current_index = 0
-        for device in devices.device_handle:
-            if device.device_type == device_type:
-                if current_index == device_index:
-                    print ("Found the Interconnect on device identifier {}".format(device.device_identifier))
-                    return device.device_identifier
-                current_index += 1
-        return None
+        # The device list is read once per session
+        device_id = utilities.device_metadata(self.router).device_id(device_type, device_index)
+        if device_id is not None:
+            print ("Found the Interconnect on device identifier {}".format(device_id))
+        return device_id
 
     def EnableEthernetBridge(self):
 
@@ -58,10 +57,7 @@ class EthernetBridgeConfigurationExample:
             print ("An unexpected error occured : {}".format(e))
 
 def main():
-    # Import the utilities helper module
     import argparse
-    sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
-    import utilities
 
     # Parse arguments
     parser = argparse.ArgumentParser()
@@ -17,6 +17,10 @@ import os
 import time
 import threading
 
+# Import the utilities helper module
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import utilities
+
 from kortex_api.autogen.client_stubs.BaseClientRpc import BaseClient
 from kortex_api.autogen.client_stubs.BaseCyclicClientRpc import BaseCyclicClient
 
@@ -94,7 +98,8 @@ def example_trajectory(base, base_cyclic):
     base.SetServoingMode(base_servo_mode)
 
     jointPoses = tuple(tuple())
-    product = base.GetProductConfiguration()
+    # Read once per session
+    product = utilities.device_metadata(base.router).product_configuration
 
     if(   product.model == Base_pb2.ProductConfiguration__pb2.MODEL_ID_L53 
     or product.model == Base_pb2.ProductConfiguration__pb2.MODEL_ID_L31):
@@ -177,10 +182,6 @@ def example_trajectory(base, base_cyclic):
 
 def main():
     
-    # Import the utilities helper module
-    sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
-    import utilities
-
     # Parse arguments
     args = utilities.parseConnectionArguments()
     
@@ -0,0 +1,81 @@
+#! /usr/bin/env python3
+
+###
+# KINOVA (R) KORTEX (TM)
+#
+# Copyright (c) 2018 Kinova inc. All rights reserved.
+#
+# This software may be modified and distributed
+# under the terms of the BSD 3-Clause license.
+#
+# Refer to the LICENSE file for details.
+#
+###
+
+import os
+import sys
+import threading
+
+from kortex_api.autogen.messages import Base_pb2
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import utilities
+
+class ActionRegistry:
+    """Index of the actions stored on the device, by type and name
+
+    Each action type is read with one ReadAllActions the first time it is
+    looked up. The whole index is dropped on any configuration change
+    notification, so actions edited from the Web App are read again.
+    """
+
+    def __init__(self, base):
+        self.base = base
+        self.lock = threading.Lock()
+        self.index = {} # action type -> {name: Action}
+        self.generation = 0 # bumped on every invalidation
+        self.notification_handle = base.OnNotificationConfigurationChangeTopic(self._on_configuration_change, Base_pb2.NotificationOptions())
+
+    def close(self):
+        if self.notification_handle is not None:
+            self.base.Unsubscribe(self.notification_handle)
+            self.notification_handle = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _on_configuration_change(self, notification):
+        with self.lock:
+            self.index = {}
+            self.generation += 1
+
+    def handle(self, name, action_type=Base_pb2.REACH_JOINT_ANGLES):
+        """ActionHandle of the stored action with this type and name, or None"""
+        action = self.action(name, action_type)
+        return action.handle if action is not None else None
+
+    def action(self, name, action_type=Base_pb2.REACH_JOINT_ANGLES):
+        """Stored Base_pb2.Action (with its target) with this type and name, or None"""
+        with self.lock:
+            names = self.index.get(action_type)
+            generation = self.generation
+        if names is None:
+            requested_type = Base_pb2.RequestedActionType()
+            requested_type.action_type = action_type
+            names = {}
+            for action in self.base.ReadAllActions(requested_type).action_list:
+                names[action.name] = action
+            with self.lock:
+                # Keep the list unless a configuration change arrived meanwhile
+                if generation == self.generation:
+                    self.index[action_type] = names
+        return names.get(name)
+
+_registries = utilities.SessionRegistry(ActionRegistry)
+
+def action_registry(base):
+    """The session ActionRegistry of a BaseClient, subscribed on first use"""
+    return _registries.get(base)
@@ -0,0 +1,349 @@
+#! /usr/bin/env python3
+
+###
+# KINOVA (R) KORTEX (TM)
+#
+# Copyright (c) 2018 Kinova inc. All rights reserved.
+#
+# This software may be modified and distributed
+# under the terms of the BSD 3-Clause license.
+#
+# Refer to the LICENSE file for details.
+#
+###
+
+import hashlib
+import itertools
+import math
+import threading
+import time
+
+import numpy as np
+
+from kortex_api.autogen.messages import Base_pb2
+
+from motion_timing import estimate_motion_time, load_limits
+from motion_executor import motion_executor
+from action_registry import action_registry
+
+# Maximum waiting time on top of the estimated duration of a sequence (in seconds)
+SEQUENCE_TIMEOUT_MARGIN = 10
+# Steps that move the arm
+ARM_STEPS = ('home', 'cartesian', 'joint')
+# Delay after a gripper task of a sequence before the next task starts (in seconds)
+GRIPPER_SETTLE_TIME = 1
+
+class Choreography:
+    """Builder of a device-side Base_pb2.Sequence from a script of moves
+
+    Every step starts a new task group unless added with parallel=True, in
+    which case it shares the group of the previous step. Only run_choreography
+    starts the steps of a group together: the device ignores the deprecated
+    group_identifier of sequence tasks and plays them one after the other.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.steps = [] # (group, kind, target)
+        self.contacts = [] # per step: gripper step needing the arm at rest (None = infer)
+
+    def _add(self, kind, target, parallel, contact=None):
+        if not self.steps:
+            group = 0
+        elif parallel:
+            group = self.steps[-1][0]
+        else:
+            group = self.steps[-1][0] + 1
+        self.steps.append((group, kind, target))
+        self.contacts.append(contact)
+        return self
+
+    def home(self, parallel=False):
+        return self._add('home', None, parallel)
+
+    def cartesian(self, pose, parallel=False):
+        return self._add('cartesian', tuple(float(v) for v in pose), parallel)
+
+    def joints(self, joint_angles, parallel=False):
+        return self._add('joint', tuple(float(v) for v in joint_angles), parallel)
+
+    def gripper(self, position, parallel=False, contact=None):
+        """Add a gripper step; contact tells overlap_gripper_steps whether it grasps or releases"""
+        return self._add('gripper', float(position), parallel, contact)
+
+    def wait(self, seconds, parallel=False):
+        # Delay actions count whole seconds
+        return self._add('wait', int(math.ceil(seconds)), parallel)
+
+    def content_hash(self, home=None):
+        """SHA-256 of the name and of the tasks build(home) uploads, identifying the sequence
+
+        The serialized tasks include the settle delays and the joint angles of
+        the stored Home action, so a sequence uploaded before either changed
+        is not found and replayed.
+        """
+        tasks = self._unnamed_sequence(home).SerializeToString(deterministic=True)
+        return hashlib.sha256(self.name.encode() + tasks).hexdigest()
+
+    def actions(self):
+        """(kind, target) pairs for motion_timing.estimate_motion_time"""
+        return [(kind, target) for _, kind, target in self.steps]
+
+    def estimated_duration(self, limits=None, sequential=False):
+        """Estimated duration (s)
+
+        By default the steps of a group last as long as the slowest one, as
+        in run_choreography. With sequential=True every task of the device
+        sequence runs after the previous one, as PlaySequence does.
+        """
+        if sequential:
+            times, _ = estimate_motion_time([(kind, target) for _, kind, target in self.tasks()], limits=limits or load_limits())
+            return float(np.sum(times))
+        times, _ = estimate_motion_time(self.actions(), limits=limits or load_limits())
+        groups = np.array([group for group, _, _ in self.steps], dtype=np.int64)
+        longest = np.zeros(groups.max() + 1 if len(groups) else 0)
+        np.maximum.at(longest, groups, times)
+        return float(longest.sum())
+
+    def groups(self):
+        """Yield the steps of each task group, as (kind, target) lists"""
+        for _, steps in itertools.groupby(self.steps, key=lambda step: step[0]):
+            yield [(kind, target) for _, kind, target in steps]
+
+    def tasks(self):
+        """(group, kind, target) of the sequence tasks: the steps, with a settle delay after gripper steps
+
+        The device does not wait for the fingers to stop before the next
+        task, so gripper steps that may grasp or release (contact not False)
+        are followed by a GRIPPER_SETTLE_TIME delay.
+        """
+        tasks = []
+        for (group, kind, target), contact in zip(self.steps, self.contacts):
+            tasks.append((group, kind, target))
+            if kind == 'gripper' and contact is not False:
+                tasks.append((group, 'wait', GRIPPER_SETTLE_TIME))
+        return tasks
+
+    def build(self, home=None):
+        """Return the Base_pb2.Sequence, named after the content hash
+
+        Arguments:
+        home -- the "Home" Base_pb2.Action stored on the device, needed by home steps
+        """
+        sequence = self._unnamed_sequence(home)
+        sequence.name = "{} {}".format(self.name, self.content_hash(home)[:12])
+        return sequence
+
+    def _unnamed_sequence(self, home):
+        sequence = Base_pb2.Sequence()
+        for index, (group, kind, target) in enumerate(self.tasks()):
+            task = sequence.tasks.add()
+            task.group_identifier = group
+            task.action.CopyFrom(step_action(kind, target, "{} {}".format(kind, index), home))
+        return sequence
+
+def home_action(base):
+    """The "Home" action stored on the device, as example_move_to_home_position reaches it"""
+    action = action_registry(base).action("Home", Base_pb2.REACH_JOINT_ANGLES)
+    if action is None:
+        raise ValueError("no Home action on the device")
+    return action
+
+def step_action(kind, target, name="", home=None):
+    """Return the Base_pb2.Action of a choreography step
+
+    home is the "Home" action stored on the device (see home_action); home
+    steps reach its joint angles, which match the arm model.
+    """
+    action = Base_pb2.Action()
+    action.name = name
+    action.application_data = ""
+
+    if kind == 'home':
+        if home is None:
+            raise ValueError("home steps need the stored Home action")
+        action.reach_joint_angles.CopyFrom(home.reach_joint_angles)
+    elif kind == 'joint':
+        for joint_id, value in enumerate(target):
+            joint_angle = action.reach_joint_angles.joint_angles.joint_angles.add()
+            joint_angle.joint_identifier = joint_id
+            joint_angle.value = value
+    elif kind == 'cartesian':
+        cartesian_pose = action.reach_pose.target_pose
+        cartesian_pose.x, cartesian_pose.y, cartesian_pose.z = target[:3] # (meters)
+        cartesian_pose.theta_x, cartesian_pose.theta_y, cartesian_pose.theta_z = target[3:] # (degrees)
+    elif kind == 'gripper':
+        action.send_gripper_command.mode = Base_pb2.GRIPPER_POSITION
+        finger = action.send_gripper_command.gripper.finger.add()
+        finger.finger_identifier = 1
+        finger.value = target
+    elif kind == 'wait':
+        action.delay.duration = target
+    else:
+        raise ValueError("unknown choreography step {!r}".format(kind))
+    return action
+
+class SequencePlayer:
+    """Upload choreographies once and replay them by sequence handle
+
+    Handles are cached by content hash. Sequences are named after that hash,
+    so a sequence uploaded by an earlier session is found with one
+    ReadAllSequences instead of being created again.
+    """
+
+    def __init__(self, base):
+        self.base = base
+        self.handles = None # content hash prefix -> SequenceHandle
+        self.lock = threading.Lock()
+        self.playing = None # (sequence identifier, number of tasks, Event, result list)
+        self.notification_handle = base.OnNotificationSequenceInfoTopic(self._on_sequence_info, Base_pb2.NotificationOptions())
+
+    def close(self):
+        if self.notification_handle is not None:
+            self.base.Unsubscribe(self.notification_handle)
+            self.notification_handle = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _on_sequence_info(self, notification):
+        with self.lock:
+            playing = self.playing
+        if playing is None or notification.sequence_handle.identifier != playing[0]:
+            return
+        _, num_tasks, done, result = playing
+
+        event_id = notification.event_identifier
+        if event_id == Base_pb2.SEQUENCE_TASK_COMPLETED:
+            print("Sequence task {}/{} completed".format(notification.task_index + 1, num_tasks))
+        elif event_id == Base_pb2.SEQUENCE_ABORTED:
+            print("Sequence aborted with error {}:{}".format(
+                notification.abort_details, Base_pb2.SubErrorCodes.Name(notification.abort_details)))
+            result.append(False)
+            done.set()
+        elif event_id == Base_pb2.SEQUENCE_COMPLETED:
+            print("Sequence completed.")
+            result.append(True)
+            done.set()
+
+    def upload(self, choreography):
+        """Return the SequenceHandle of a choreography, creating it on the device if needed"""
+        if self.handles is None:
+            self.handles = {}
+            for sequence in self.base.ReadAllSequences().sequence_list:
+                self.handles[sequence.name.rsplit(" ", 1)[-1]] = sequence.handle
+
+        home = home_action(self.base) if any(kind == 'home' for _, kind, _ in choreography.steps) else None
+        key = choreography.content_hash(home)[:12]
+        handle = self.handles.get(key)
+        if handle is None:
+            print("Uploading sequence {}".format(choreography.name))
+            handle = self.handles[key] = self.base.CreateSequence(choreography.build(home))
+        return handle
+
+    def play(self, choreography, timeout=None):
+        """Play a choreography on the device and wait for it; False on abort or timeout"""
+        handle = self.upload(choreography)
+        if timeout is None:
+            timeout = choreography.estimated_duration(sequential=True) + SEQUENCE_TIMEOUT_MARGIN
+
+        done = threading.Event()
+        result = []
+        with self.lock:
+            self.playing = (handle.identifier, len(choreography.tasks()), done, result)
+        try:
+            self.base.PlaySequence(handle)
+            finished = done.wait(timeout)
+        finally:
+            with self.lock:
+                self.playing = None
+
+        if not finished:
+            print("Timeout on sequence notification wait")
+            return False
+        return result[0]
+
+def overlap_gripper_steps(choreography, initial_position=0.0):
+    """Return a copy of a choreography where free gripper steps run during arm moves
+
+    Arguments:
+    choreography -- Choreography to reschedule
+    initial_position -- gripper position before the first step (0 = open)
+
+    Grasping and releasing need the arm at rest at the contact pose, so
+    those steps stay ordered after the previous move and before the next
+    one. Other gripper steps only pre-shape the fingers and start with the
+    arm move before them (or the one after them at the start of the
+    choreography). Steps added with contact=None are inferred: closing
+    grasps, and opening after a grasp releases. The overlap only happens
+    with run_choreography; a device sequence still plays every task in turn.
+    """
+    overlapped = Choreography(choreography.name)
+    position = initial_position
+    holding = False
+    join_next = False
+    for (_, kind, target), contact in zip(choreography.steps, choreography.contacts):
+        if kind == 'gripper':
+            if contact is None:
+                contact = target > position or (holding and target < position)
+            holding = (target > position and contact) or (holding and target >= position)
+            position = target
+            if not contact:
+                previous = overlapped.steps[-1][1] if overlapped.steps else None
+                if previous in ARM_STEPS:
+                    overlapped._add(kind, target, True, contact)
+                    continue
+                join_next = True
+                overlapped._add(kind, target, False, contact)
+                continue
+
+        overlapped._add(kind, target, join_next and kind in ARM_STEPS, contact if kind == 'gripper' else None)
+        join_next = False
+    return overlapped
+
+def run_choreography(choreography, base, gripper, timeout=None):
+    """Play a choreography from the host, starting the steps of a group together
+
+    Arguments:
+    choreography -- Choreography to play
+    base -- BaseClient, whose session MotionExecutor runs the arm steps
+    gripper -- GripperController running the gripper steps
+    timeout -- longest wait for one group (s), by default its estimate plus SEQUENCE_TIMEOUT_MARGIN
+
+    The host-side alternative to SequencePlayer: the arm step and the gripper
+    steps of a group each return a concurrent.futures.Future, and the group
+    ends when all of them are resolved. The base runs one action at a time,
+    so a group holds at most one arm step; waits are slept on the host.
+    Returns False as soon as a group fails.
+    """
+    executor = motion_executor(base)
+    limits = load_limits()
+    home = home_action(base) if any(kind == 'home' for _, kind, _ in choreography.steps) else None
+    for steps in choreography.groups():
+        if sum(kind in ARM_STEPS for kind, _ in steps) > 1:
+            raise ValueError("a group can only move the arm once: {}".format(steps))
+        group = Choreography(choreography.name)
+        for kind, target in steps:
+            group._add(kind, target, parallel=True)
+        group_timeout = timeout or group.estimated_duration(limits) + SEQUENCE_TIMEOUT_MARGIN
+
+        arm = None
+        grippers = []
+        for kind, target in steps:
+            if kind in ARM_STEPS:
+                arm = executor.execute_action(step_action(kind, target, home=home))
+            elif kind == 'gripper':
+                grippers.append(gripper.move_async(target, group_timeout))
+        for kind, target in steps:
+            if kind == 'wait':
+                time.sleep(target)
+
+        success = executor.wait(arm, group_timeout) if arm is not None else True
+        for future in grippers:
+            success &= future.result()
+        if not success:
+            return False
+    return True
@@ -12,10 +12,17 @@
 #
 ###
 
-import time
 import sys
 import os
-import threading
+from motion_timing import estimate_motion_time, load_limits
+from motion_executor import motion_executor
+from action_registry import action_registry
+from gripper import GripperController, GRIPPER_TIMEOUT
+from feedback_cache import feedback_cache, running_feedback_cache
+from choreography import Choreography, SequencePlayer, overlap_gripper_steps, run_choreography
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import utilities
 
 from kortex_api.autogen.client_stubs.BaseClientRpc import BaseClient
 from kortex_api.autogen.client_stubs.BaseCyclicClientRpc import BaseCyclicClient
@@ -27,51 +34,10 @@ from kortex_api.autogen.messages import Session_pb2, Base_pb2
 # Maximum allowed waiting time during actions (in seconds)
 TIMEOUT_DURATION = 10
 
-# Create closure to set an event after an END or an ABORT
-def check_for_sequence_end_or_abort(e):
-    """Return a closure checking for END or ABORT notifications on a sequence
-
-    Arguments:
-    e -- event to signal when the action is completed
-        (will be set when an END or ABORT occurs)
-    """
-
-    def check(notification, e = e):
-        event_id = notification.event_identifier
-        task_id = notification.task_index
-        if event_id == Base_pb2.SEQUENCE_TASK_COMPLETED:
-            print("Sequence task {} completed".format(task_id))
-        elif event_id == Base_pb2.SEQUENCE_ABORTED:
-            print("Sequence aborted with error {}:{}"\
-                .format(\
-                    notification.abort_details,\
-                    Base_pb2.SubErrorCodes.Name(notification.abort_details)))
-            e.set()
-        elif event_id == Base_pb2.SEQUENCE_COMPLETED:
-            print("Sequence completed.")
-            e.set()
-    return check
-
-# Create closure to set an event after an END or an ABORT
-def check_for_end_or_abort(e):
-    """Return a closure checking for END or ABORT notifications
-
-    Arguments:
-    e -- event to signal when the action is completed
-        (will be set when an END or ABORT occurs)
-    """
-    def check(notification, e = e):
-        print("EVENT : " + \
-              Base_pb2.ActionEvent.Name(notification.action_event))
-        if notification.action_event == Base_pb2.ACTION_END \
-        or notification.action_event == Base_pb2.ACTION_ABORT:
-            e.set()
-    return check
-
 #
 # Example related functions
 #
-def example_move_to_home_position(base):
+def example_move_to_home_position(base, base_cyclic=None):
     # Make sure the arm is in Single Level Servoing mode
     base_servo_mode = Base_pb2.ServoingModeInformation()
     base_servo_mode.servoing_mode = Base_pb2.SINGLE_LEVEL_SERVOING
@@ -79,63 +45,46 @@ def example_move_to_home_position(base):
     
     # Move arm to ready position
     print("Moving the arm to a safe position")
-    action_type = Base_pb2.RequestedActionType()
-    action_type.action_type = Base_pb2.REACH_JOINT_ANGLES
-    action_list = base.ReadAllActions(action_type)
-    action_handle = None
-    for action in action_list.action_list:
-        if action.name == "Home":
-            action_handle = action.handle
-
-    if action_handle == None:
+    action = action_registry(base).action("Home", Base_pb2.REACH_JOINT_ANGLES)
+
+    if action == None:
         print("Can't reach safe position. Exiting")
         sys.exit(0)
 
-    e = threading.Event()
-    notification_handle = base.OnNotificationActionTopic(
-        check_for_end_or_abort(e),
-        Base_pb2.NotificationOptions()
-    )
-
-    base.ExecuteActionFromReference(action_handle)
-
-    # Leave time to action to complete # TODO timing out here!!
-    finished = e.wait(TIMEOUT_DURATION)
-    base.Unsubscribe(notification_handle)
-    
-    if not finished:
-        print("Timeout on action notification wait")
+    executor = motion_executor(base)
+    home_angles = [joint_angle.value for joint_angle in action.reach_joint_angles.joint_angles.joint_angles]
+    # Only checked while a feedback cache runs, no thread is started for it
+    cache = running_feedback_cache(base_cyclic) if base_cyclic is not None else None
+    if cache is not None and cache.at_joint_angles(home_angles):
+        print("Already at the safe position")
+        executor.skip()
+        return True
+    future = executor.execute_action_from_reference(action.handle)
+
+    # Leave time to action to complete
+    finished = executor.wait(future, TIMEOUT_DURATION)
     return finished
 
 class GripperCommandExample:
-    def __init__(self, router, proportional_gain = 2.0):
+    def __init__(self, router, proportional_gain = 2.0, base_cyclic = None):
 
         self.proportional_gain = proportional_gain
         self.router = router
 
         # Create base client using TCP router
         self.base = BaseClient(self.router)
-
-    def ExampleSendGripperCommands(self, base, position):
-
-        # Create the GripperCommand we will send
-        gripper_command = Base_pb2.GripperCommand()
-        finger = gripper_command.gripper.finger.add()
-
-        # e = threading.Event()
-        # notification_handle = base.OnNotificationActionTopic(
-        #     check_for_end_or_abort(e),
-        #     Base_pb2.NotificationOptions()
-        # )
-
-        # Close the gripper with position increments
-        print("Performing gripper test in position...")
-        gripper_command.mode = Base_pb2.GRIPPER_POSITION
-        finger.finger_identifier = 1
-        finger.value = position
-        print("Going to position {:0.2f}...".format(finger.value))
-        self.base.SendGripperCommand(gripper_command)
-        time.sleep(1) # necessary, gives gripper time to move
+        self.base_cyclic = base_cyclic or BaseCyclicClient(self.router)
+        self.controller = GripperController(self.base, self.base_cyclic)
+
+    def ExampleSendGripperCommands(self, base, position, timeout=GRIPPER_TIMEOUT):
+        # Returns once the fingers reach the position or stall on an object
+        print("Going to position {:0.2f}...".format(position))
+        return self.controller.move(position, timeout)
+
+    def SendGripperCommandAsync(self, position, timeout=GRIPPER_TIMEOUT):
+        # Returns a Future resolved once the fingers reach the position or stall
+        print("Going to position {:0.2f}...".format(position))
+        return self.controller.move_async(position, timeout)
         
 
 
@@ -146,30 +95,23 @@ def angular_action(base, joint_angles):
     action.name = "Example angular action movement"
     action.application_data = ""
 
-    actuator_count = base.GetActuatorCount()
-    
-    for joint_id in range(actuator_count.count):
+    # Read once per session
+    actuator_count = utilities.device_metadata(base.router).actuator_count
+
+    for joint_id in range(actuator_count):
         joint_angle = action.reach_joint_angles.joint_angles.joint_angles.add()
         joint_angle.joint_identifier = joint_id
         joint_angle.value = joint_angles[joint_id]
 
-    e = threading.Event()
-    notification_handle = base.OnNotificationActionTopic(
-        check_for_end_or_abort(e),
-        Base_pb2.NotificationOptions()
-    )
-    
+    executor = motion_executor(base)
     print("Executing action")
-    base.ExecuteAction(action)
+    future = executor.execute_action(action)
 
     print("Waiting for movement to finish ...")
-    finished = e.wait(TIMEOUT_DURATION)
-    base.Unsubscribe(notification_handle)
+    finished = executor.wait(future, TIMEOUT_DURATION)
 
     if finished:
         print("Angular movement completed")
-    else:
-        print("Timeout on action notification wait")
     return finished
 
 def cartesian_action(base, base_cyclic, pose):
@@ -180,8 +122,6 @@ def cartesian_action(base, base_cyclic, pose):
     action.name = "Example Cartesian action movement"
     action.application_data = ""
 
-    feedback = base_cyclic.RefreshFeedback()
-
     cartesian_pose = action.reach_pose.target_pose
     cartesian_pose.x = x #feedback.base.tool_pose_x          # (meters)
     cartesian_pose.y = y #feedback.base.tool_pose_y - 0.1    # (meters)
@@ -190,23 +130,20 @@ def cartesian_action(base, base_cyclic, pose):
     cartesian_pose.theta_y = theta_y # (degrees)
     cartesian_pose.theta_z = theta_z # (degrees)
 
-    e = threading.Event()
-    notification_handle = base.OnNotificationActionTopic(
-        check_for_end_or_abort(e),
-        Base_pb2.NotificationOptions()
-    )
-
+    executor = motion_executor(base)
+    cache = running_feedback_cache(base_cyclic)
+    if cache is not None and cache.at_pose(pose):
+        print("Already at the target pose")
+        executor.skip()
+        return True
     print("Executing action")
-    base.ExecuteAction(action)
+    future = executor.execute_action(action)
 
     print("Waiting for movement to finish ...")
-    finished = e.wait(TIMEOUT_DURATION)
-    base.Unsubscribe(notification_handle)
+    finished = executor.wait(future, TIMEOUT_DURATION)
 
     if finished:
         print("Cartesian movement completed")
-    else:
-        print("Timeout on action notification wait")
     return finished
 
 #
@@ -215,140 +152,129 @@ def cartesian_action(base, base_cyclic, pose):
 #
 
 def robo_cocoa_choreo():
-# POUR ANGLE, CLOCKWISE = LOWER
+    """The hot cocoa choreography, to play with run_choreography or SequencePlayer"""
+    # POUR ANGLE, CLOCKWISE = LOWER
     pour_angle_right = 178.67
 
-    success = True
-    gripper_pos = 0.0
-    gripper.ExampleSendGripperCommands(base, gripper_pos)
+    choreo = Choreography("robo cocoa")
+    choreo.gripper(0.0)
 
     # HOME
-    success &= example_move_to_home_position(base)
+    choreo.home()
+
     # START
     start_pos = (.48, -.117, .177, 90, 0, 90)
-    success &= cartesian_action(base, base_cyclic, start_pos)
+    choreo.cartesian(start_pos)
 
     # OPEN
-    gripper_pos = 0.39
-    gripper.ExampleSendGripperCommands(base, gripper_pos)
+    choreo.gripper(0.39, contact=False)
 
     # TOWARDS CUP
-    pos = (.697, -.404, .23, 90, 0, 90)
-    success &= cartesian_action(base, base_cyclic, pos)
-    pos = (.776, -.404, .23, 90, 0, 90)
-    success &= cartesian_action(base, base_cyclic, pos)
+    choreo.cartesian((.697, -.404, .23, 90, 0, 90))
+    choreo.cartesian((.776, -.404, .23, 90, 0, 90))
 
     # PICK UP CUP
-    gripper_pos = 0.93
-    gripper.ExampleSendGripperCommands(base, gripper_pos)
-    pos = (.776, -.404, .389, 90, 0, 90)
-    success &= cartesian_action(base, base_cyclic, pos)
+    choreo.gripper(0.93, contact=True)
+    choreo.cartesian((.776, -.404, .389, 90, 0, 90))
 
     # POUR
-    pos = (0.735, -.135, 0.389, 90, 0, 90)
-    success &= cartesian_action(base, base_cyclic, pos)
-    twist = [5.32, 37.76, 197.55, 259.44, 24, 53.18, 182.67]
-    success &= angular_action(base, twist)
+    choreo.cartesian((0.735, -.135, 0.389, 90, 0, 90))
+    choreo.joints([5.32, 37.76, 197.55, 259.44, 24, 53.18, 182.67])
 
     # shake a little
     for _ in range(4):
-        twist = [5.32, 37.76, 197.55, 259.44, 24, 53.18, 184.67]
-        success &= angular_action(base, twist)
-        twist = [5.32, 37.76, 197.55, 259.44, 24, 53.18, 182.67]
-        success &= angular_action(base, twist)
-    
-    time.sleep(2)
-    twist = [5.32, 37.76, 197.55, 259.44, 24, 53.18, 77]
-    success &= angular_action(base, twist)
-    
+        choreo.joints([5.32, 37.76, 197.55, 259.44, 24, 53.18, 184.67])
+        choreo.joints([5.32, 37.76, 197.55, 259.44, 24, 53.18, 182.67])
+
+    choreo.wait(2)
+    choreo.joints([5.32, 37.76, 197.55, 259.44, 24, 53.18, 77])
+
     # RETURN CUP
-    pos = (.776, -.404, .389, 90, 0, 90)
-    success &= cartesian_action(base, base_cyclic, pos)
-    pos = (.729, -.404, .22, 90, 0, 90)
-    success &= cartesian_action(base, base_cyclic, pos)
-    gripper_pos = 0.39
-    gripper.ExampleSendGripperCommands(base, gripper_pos)
-    pos = (.6, -.404, .22, 90, 0, 90)
-    success &= cartesian_action(base, base_cyclic, pos)
+    choreo.cartesian((.776, -.404, .389, 90, 0, 90))
+    choreo.cartesian((.729, -.404, .22, 90, 0, 90))
+    choreo.gripper(0.39, contact=True)
+    choreo.cartesian((.6, -.404, .22, 90, 0, 90))
 
     # HOME
-    success &= example_move_to_home_position(base)
-    gripper_pos = 0.0
-    gripper.ExampleSendGripperCommands(base, gripper_pos)
-    
+    choreo.home()
+    choreo.gripper(0.0)
+
     # PICK UP STIRRER
-    pos = (.79, .05, .26, 90, 0, 90)
-    success &= cartesian_action(base, base_cyclic, pos)
-    gripper_pos = 1.0
-    gripper.ExampleSendGripperCommands(base, gripper_pos)
+    choreo.cartesian((.79, .05, .26, 90, 0, 90))
+    choreo.gripper(1.0)
     # up
-    pos = (.79, .05, .42, 90, 0, 90)
-    success &= cartesian_action(base, base_cyclic, pos)
+    choreo.cartesian((.79, .05, .42, 90, 0, 90))
     # on top of cocoa
-    pos = (.72, -.11, .42, 90, 0, 90)
-    success &= cartesian_action(base, base_cyclic, pos)
+    choreo.cartesian((.72, -.11, .42, 90, 0, 90))
     # down
-    pos = (.72, -.155, .312, 90, 0, 90)
-    success &= cartesian_action(base, base_cyclic, pos)
+    choreo.cartesian((.72, -.155, .312, 90, 0, 90))
 
     # STIR
     for _ in range(7):
-        pos = (.751, -.13, .312, 90, 0, 90)
-        success &= cartesian_action(base, base_cyclic, pos)
-        pos = (.775, -.165, .312, 90, 0, 90)
-        success &= cartesian_action(base, base_cyclic, pos)
-        pos = (.751, -.19, .312, 90, 0, 90)
-        success &= cartesian_action(base, base_cyclic, pos)
-        pos = (.72, -.155, .312, 90, 0, 90)
-        success &= cartesian_action(base, base_cyclic, pos)
+        choreo.cartesian((.751, -.13, .312, 90, 0, 90))
+        choreo.cartesian((.775, -.165, .312, 90, 0, 90))
+        choreo.cartesian((.751, -.19, .312, 90, 0, 90))
+        choreo.cartesian((.72, -.155, .312, 90, 0, 90))
 
     # lift up
-    pos = (.716, -.11, .42, 90, 0, 90)
-    success &= cartesian_action(base, base_cyclic, pos)
-    pos = (.616, -.11, .42, 90, 0, 90)
-    success &= cartesian_action(base, base_cyclic, pos)
+    choreo.cartesian((.716, -.11, .42, 90, 0, 90))
+    choreo.cartesian((.616, -.11, .42, 90, 0, 90))
     # drop
-    gripper_pos = 0.0
-    gripper.ExampleSendGripperCommands(base, gripper_pos)
+    choreo.gripper(0.0)
+
+    return choreo
 
 def main():
-    # Import the utilities helper module
     import argparse
-    sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
-    import utilities
 
     # Parse arguments
     parser = argparse.ArgumentParser()
-    args = utilities.parseConnectionArguments()
+    parser.add_argument("--cocoa", action="store_true", help="run the hot cocoa choreography from the host, gripper moves overlapping arm moves")
+    parser.add_argument("--sequence", action="store_true", help="with --cocoa, play the choreography as a device-side sequence, one task at a time")
+    args = utilities.parseConnectionArguments(parser)
 
     # Create connection to the device and get the router
     with utilities.DeviceConnection.createTcpConnection(args) as router:
 
         # Create required services
-        gripper = GripperCommandExample(router)
         base = BaseClient(router)
         base_cyclic = BaseCyclicClient(router)
+        gripper = GripperCommandExample(router, base_cyclic=base_cyclic)
+
+        if args.cocoa:
+            if args.sequence:
+                # The device plays the tasks one after the other, nothing overlaps
+                choreo = robo_cocoa_choreo()
+                print("Estimated duration: {:.1f} s".format(choreo.estimated_duration(sequential=True)))
+                with SequencePlayer(base) as player:
+                    return 0 if player.play(choreo) else 1
+            # Pre-shape the gripper while the arm is still moving
+            choreo = overlap_gripper_steps(robo_cocoa_choreo())
+            print("Estimated duration: {:.1f} s".format(choreo.estimated_duration()))
+            with feedback_cache(base_cyclic):
+                return 0 if run_choreography(choreo, base, gripper.controller) else 1
 
-        # robo_cocoa_choreo()
         success = True
-        gripper_pos = 0.88 # hold a pencil
-        gripper.ExampleSendGripperCommands(base, gripper_pos)
-
-        # HOME
-        success &= example_move_to_home_position(base)
-        # START
-        pos = (.53, .169, 0.041, 90, 0, 90)
-        success &= cartesian_action(base, base_cyclic, pos)
-        pos = (.55, .169, 0.041, 90, 0, 90)
-        success &= cartesian_action(base, base_cyclic, pos)
-        pos = (.55, .149, 0.041, 90, 0, 90)
-        success &= cartesian_action(base, base_cyclic, pos)
-        pos = (.53, .149, 0.041, 90, 0, 90)
-        success &= cartesian_action(base, base_cyclic, pos)
-
-        pos = (.53, .169, 0.041, 90, 0, 90)
-        success &= cartesian_action(base, base_cyclic, pos)
-
+        square = [(.53, .169, 0.041, 90, 0, 90),
+                  (.55, .169, 0.041, 90, 0, 90),
+                  (.55, .149, 0.041, 90, 0, 90),
+                  (.53, .149, 0.041, 90, 0, 90),
+                  (.53, .169, 0.041, 90, 0, 90)]
+        _, total = estimate_motion_time([('home', None)] + [('cartesian', pos) for pos in square], start_joints=None, limits=load_limits())
+        print("Estimated duration: {:.1f} s".format(total))
+
+        with feedback_cache(base_cyclic):
+            gripper_pos = 0.88 # hold a pencil
+            gripper.ExampleSendGripperCommands(base, gripper_pos)
+
+            # HOME
+            success &= example_move_to_home_position(base, base_cyclic)
+            # START
+            for pos in square:
+                success &= cartesian_action(base, base_cyclic, pos)
+
+        stats = motion_executor(base).stats
+        print("{} moves executed, {} skipped".format(stats['executed'], stats['skipped']))
         return 0 if success else 1
 
 if __name__ == "__main__":
@@ -0,0 +1,154 @@
+#! /usr/bin/env python3
+
+###
+# KINOVA (R) KORTEX (TM)
+#
+# Copyright (c) 2018 Kinova inc. All rights reserved.
+#
+# This software may be modified and distributed
+# under the terms of the BSD 3-Clause license.
+#
+# Refer to the LICENSE file for details.
+#
+###
+
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+from motion_timing import rotation_angle
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import utilities
+
+# Rate at which the background thread refreshes the feedback (Hz)
+FEEDBACK_RATE = 50
+# Distances under which the arm already is at a target
+JOINT_TOLERANCE = 0.2 # (deg)
+POSITION_TOLERANCE = 0.001 # (m)
+ORIENTATION_TOLERANCE = 0.2 # (deg)
+
+class FeedbackCache:
+    """Poll BaseCyclicClient.RefreshFeedback on a background thread
+
+    The latest Feedback and the time.monotonic() at which it was received are
+    published to readers without any RPC. Readers needing a sample taken
+    after some moment (e.g. the end of a move) wait for a newer one.
+    """
+
+    def __init__(self, base_cyclic, rate=FEEDBACK_RATE):
+        self.base_cyclic = base_cyclic
+        self.period = 1.0 / rate
+        self.condition = threading.Condition()
+        self.feedback = None
+        self.timestamp = None
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._poll, daemon=True)
+        self.thread.start()
+
+    def _poll(self):
+        while not self.stop_event.is_set():
+            started = time.monotonic()
+            try:
+                feedback = self.base_cyclic.RefreshFeedback()
+            except Exception as e:
+                print("Feedback refresh failed: {}".format(e))
+            else:
+                with self.condition:
+                    self.feedback = feedback
+                    self.timestamp = time.monotonic()
+                    self.condition.notify_all()
+            self.stop_event.wait(max(0.0, self.period - (time.monotonic() - started)))
+
+    def close(self):
+        self.stop_event.set()
+        if self.thread is not threading.current_thread():
+            self.thread.join()
+        _caches.discard(self.base_cyclic, self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def latest(self, newer_than=None, timeout=1.0):
+        """Return (feedback, timestamp) of the latest sample
+
+        Arguments:
+        newer_than -- if set, wait for a sample received after this time.monotonic() value
+        timeout -- longest wait (s) for the first or a newer sample
+
+        Returns (None, None) if no suitable sample arrived within the timeout.
+        """
+        with self.condition:
+            ready = self.condition.wait_for(
+                lambda: self.timestamp is not None and (newer_than is None or self.timestamp > newer_than),
+                timeout)
+            if not ready:
+                return None, None
+            return self.feedback, self.timestamp
+
+    def fresh(self, timeout=1.0):
+        """Return a Feedback sample received after this call, or None on timeout"""
+        return self.latest(time.monotonic(), timeout)[0]
+
+    def tool_pose(self, fresh=False):
+        """(x, y, z, theta_x, theta_y, theta_z) of the tool, or None"""
+        feedback = self.fresh() if fresh else self.latest()[0]
+        if feedback is None:
+            return None
+        return (feedback.base.tool_pose_x, feedback.base.tool_pose_y, feedback.base.tool_pose_z,
+                feedback.base.tool_pose_theta_x, feedback.base.tool_pose_theta_y, feedback.base.tool_pose_theta_z)
+
+    def joint_angles(self, fresh=False):
+        """Actuator positions (deg), or None"""
+        feedback = self.fresh() if fresh else self.latest()[0]
+        if feedback is None:
+            return None
+        return [actuator.position for actuator in feedback.actuators]
+
+    def at_joint_angles(self, joint_angles, tolerance=JOINT_TOLERANCE):
+        """True if every joint is within tolerance (deg) of joint_angles
+
+        Only a sample received after the call counts, so a move that ended
+        just before is seen at its final position.
+        """
+        measured = self.joint_angles(fresh=True)
+        if measured is None or len(measured) != len(joint_angles):
+            return False
+        # Actuator positions wrap around at 360 degrees
+        difference = (np.asarray(measured) - np.asarray(joint_angles, dtype=np.float64) + 180.0) % 360.0 - 180.0
+        return bool(np.all(np.abs(difference) <= tolerance))
+
+    def at_pose(self, pose, position_tolerance=POSITION_TOLERANCE, orientation_tolerance=ORIENTATION_TOLERANCE):
+        """True if the tool is within tolerance (m, deg) of pose in a sample received after the call"""
+        measured = self.tool_pose(fresh=True)
+        if measured is None:
+            return False
+        measured = np.asarray(measured)
+        pose = np.asarray(pose, dtype=np.float64)
+        return bool(np.linalg.norm(measured[:3] - pose[:3]) <= position_tolerance
+                    and rotation_angle(measured[3:], pose[3:])[0] <= orientation_tolerance)
+
+_caches = utilities.SessionRegistry(FeedbackCache)
+
+def feedback_cache(base_cyclic, rate=FEEDBACK_RATE):
+    """The session FeedbackCache of a BaseCyclicClient, started on first use
+
+    Usable as a context manager that stops the cache on exit.
+    """
+    return _caches.get(base_cyclic, rate)
+
+def running_feedback_cache(base_cyclic):
+    """The session FeedbackCache of a BaseCyclicClient if it is already started, else None"""
+    return _caches.find(base_cyclic)
+
+def close_feedback_cache(base_cyclic):
+    """Stop the session FeedbackCache of a BaseCyclicClient, if any"""
+    cache = _caches.pop(base_cyclic)
+    if cache is not None:
+        cache.close()
@@ -0,0 +1,109 @@
+#! /usr/bin/env python3
+
+###
+# KINOVA (R) KORTEX (TM)
+#
+# Copyright (c) 2018 Kinova inc. All rights reserved.
+#
+# This software may be modified and distributed
+# under the terms of the BSD 3-Clause license.
+#
+# Refer to the LICENSE file for details.
+#
+###
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from kortex_api.autogen.messages import Base_pb2
+
+from feedback_cache import running_feedback_cache
+
+# Longest wait for a gripper command to complete (in seconds)
+GRIPPER_TIMEOUT = 3.0
+# Distance to the target at which the fingers count as arrived (fraction of the stroke)
+GRIPPER_POSITION_TOLERANCE = 0.02
+# Fingers moving less than the tolerance during this time have stalled, e.g. on an object (in seconds)
+GRIPPER_STALL_TIME = 0.15
+# Fingers that have not started moving this long after the command are blocked (in seconds)
+GRIPPER_START_TIME = 0.5
+# Interval between GetMeasuredGripperMovement polls without a feedback cache (in seconds)
+GRIPPER_POLL_PERIOD = 0.02
+
+class GripperController:
+    """Position commands for the gripper that return once the fingers stop
+
+    Completion is read from the interconnect gripper feedback of the session
+    FeedbackCache (no RPC); without it, GetMeasuredGripperMovement is polled.
+    A command is complete when the fingers reach the target or stop moving
+    short of it (they closed on an object).
+    """
+
+    def __init__(self, base, base_cyclic):
+        self.base = base
+        self.base_cyclic = base_cyclic
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def position(self):
+        """Measured finger position, 0 (open) to 1 (closed), or None"""
+        cache = running_feedback_cache(self.base_cyclic)
+        feedback = cache.latest()[0] if cache is not None else None
+        if feedback is not None and len(feedback.interconnect.gripper_feedback.motor):
+            return feedback.interconnect.gripper_feedback.motor[0].position / 100.0 # (%)
+
+        gripper_request = Base_pb2.GripperRequest()
+        gripper_request.mode = Base_pb2.GRIPPER_POSITION
+        gripper_measure = self.base.GetMeasuredGripperMovement(gripper_request)
+        if len(gripper_measure.finger):
+            return gripper_measure.finger[0].value
+        return None
+
+    def send(self, position):
+        gripper_command = Base_pb2.GripperCommand()
+        gripper_command.mode = Base_pb2.GRIPPER_POSITION
+        finger = gripper_command.gripper.finger.add()
+        finger.finger_identifier = 1
+        finger.value = position
+        self.base.SendGripperCommand(gripper_command)
+
+    def wait(self, position, timeout=GRIPPER_TIMEOUT):
+        """Wait until the fingers reach position or stall; False on timeout"""
+        started = time.monotonic()
+        still_since, still_at = started, None
+        moved = False
+        while time.monotonic() - started < timeout:
+            measured = self.position()
+            if measured is None:
+                print("No gripper feedback")
+                return False
+            if abs(measured - position) <= GRIPPER_POSITION_TOLERANCE:
+                return True
+
+            now = time.monotonic()
+            if still_at is None or abs(measured - still_at) > GRIPPER_POSITION_TOLERANCE:
+                moved = still_at is not None
+                still_since, still_at = now, measured
+            elif now - still_since >= GRIPPER_STALL_TIME and (moved or now - started >= GRIPPER_START_TIME):
+                print("Gripper stopped at {:0.2f}".format(measured))
+                return True
+            cache = running_feedback_cache(self.base_cyclic)
+            if cache is not None:
+                cache.latest(newer_than=now, timeout=0.1)
+            else:
+                time.sleep(GRIPPER_POLL_PERIOD)
+
+        print("Timeout on gripper movement")
+        return False
+
+    def move(self, position, timeout=GRIPPER_TIMEOUT):
+        """Send a position command and wait for it to complete; False on timeout"""
+        self.send(position)
+        return self.wait(position, timeout)
+
+    def move_async(self, position, timeout=GRIPPER_TIMEOUT):
+        """Send a position command and return a Future of its completion"""
+        self.send(position)
+        return self.executor.submit(self.wait, position, timeout)
+
+    def close(self):
+        self.executor.shutdown()
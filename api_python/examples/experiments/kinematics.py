@@ -0,0 +1,186 @@
+#! /usr/bin/env python3
+
+# Forward kinematics of the Gen3 arms computed locally with NumPy, for many
+# joint configurations at once, and its validation against the robot.
+#
+# usage: python3 kinematics.py validate [--samples 100] [--ip 192.168.1.10]
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+# Classic DH parameters of the Gen3 arms from the user guide, one row per joint:
+# (alpha in rad, a in m, d in m, theta offset in rad). Frame 0 is the base
+# frame flipped by pi around x.
+GEN3_DH = {
+    7: np.array([
+        (np.pi / 2, 0.0, -(0.1564 + 0.1284), 0.0),
+        (np.pi / 2, 0.0, -(0.0054 + 0.0064), np.pi),
+        (np.pi / 2, 0.0, -(0.2104 + 0.2104), np.pi),
+        (np.pi / 2, 0.0, -(0.0064 + 0.0064), np.pi),
+        (np.pi / 2, 0.0, -(0.2084 + 0.1059), np.pi),
+        (np.pi / 2, 0.0, 0.0, np.pi),
+        (np.pi, 0.0, -(0.1059 + 0.0615), np.pi),
+    ]),
+    6: np.array([
+        (np.pi / 2, 0.0, -(0.1564 + 0.1284), 0.0),
+        (np.pi, 0.410, -(0.0054 + 0.0064), -np.pi / 2),
+        (np.pi / 2, 0.0, -(0.0064 + 0.0064), -np.pi / 2),
+        (np.pi / 2, 0.0, -(0.2084 + 0.1059), np.pi),
+        (np.pi / 2, 0.0, 0.0, np.pi),
+        (np.pi, 0.0, -(0.1059 + 0.0615), np.pi),
+    ]),
+}
+# Range of the joints that do not turn continuously (+/- deg, None = continuous)
+GEN3_JOINT_LIMITS = {
+    7: (None, 128.9, None, 147.8, None, 120.3, None),
+    6: (None, 128.9, 147.8, None, 120.3, None),
+}
+# Tool transform of the Robotiq 2F-85 gripper, the one of the "Home" tool pose
+GRIPPER_TOOL_TRANSFORM = (0.0, 0.0, 0.12, 0.0, 0.0, 0.0)
+
+def rotation_matrices(thetas):
+    """(N, 3, 3) rotations of Kinova orientations: extrinsic X, then Y, then Z, in degrees"""
+    tx, ty, tz = np.radians(np.asarray(thetas, dtype=np.float64)).T
+    cx, cy, cz = np.cos(tx), np.cos(ty), np.cos(tz)
+    sx, sy, sz = np.sin(tx), np.sin(ty), np.sin(tz)
+    return np.stack((
+        np.stack((cz * cy, cz * sy * sx - sz * cx, cz * sy * cx + sz * sx), axis=-1),
+        np.stack((sz * cy, sz * sy * sx + cz * cx, sz * sy * cx - cz * sx), axis=-1),
+        np.stack((-sy, cy * sx, cy * cx), axis=-1),
+    ), axis=-2)
+
+def pose_matrices(poses):
+    """(N, 4, 4) homogeneous transforms of (N, 6) Kinova poses"""
+    poses = np.atleast_2d(np.asarray(poses, dtype=np.float64))
+    matrices = np.zeros((len(poses), 4, 4))
+    matrices[:, :3, :3] = rotation_matrices(poses[:, 3:])
+    matrices[:, :3, 3] = poses[:, :3]
+    matrices[:, 3, 3] = 1.0
+    return matrices
+
+def rotation_thetas(rotations):
+    """(N, 3) Kinova orientations (deg) of (N, 3, 3) rotations, inverse of rotation_matrices
+
+    At theta_y = +/-90 deg only theta_x - theta_z (or their sum) is defined;
+    theta_x is then returned as 0.
+    """
+    theta_y = -np.arcsin(np.clip(rotations[:, 2, 0], -1.0, 1.0))
+    gimbal_lock = np.abs(rotations[:, 2, 0]) > 1.0 - 1e-9
+    theta_x = np.where(gimbal_lock, 0.0, np.arctan2(rotations[:, 2, 1], rotations[:, 2, 2]))
+    theta_z = np.where(gimbal_lock,
+                       np.arctan2(-rotations[:, 0, 1], rotations[:, 1, 1]),
+                       np.arctan2(rotations[:, 1, 0], rotations[:, 0, 0]))
+    return np.degrees(np.column_stack((theta_x, theta_y, theta_z)))
+
+def matrix_poses(matrices):
+    """(N, 6) Kinova poses of (N, 4, 4) homogeneous transforms"""
+    return np.column_stack((matrices[:, :3, 3], rotation_thetas(matrices[:, :3, :3])))
+
+def dh_transforms(alpha, a, d, theta):
+    """(..., 4, 4) classic DH transforms, elementwise on broadcast arrays"""
+    alpha, a, d, theta = np.broadcast_arrays(alpha, a, d, theta)
+    ca, sa = np.cos(alpha), np.sin(alpha)
+    ct, st = np.cos(theta), np.sin(theta)
+    zero, one = np.zeros_like(theta), np.ones_like(theta)
+    return np.stack((
+        np.stack((ct, -st * ca, st * sa, a * ct), axis=-1),
+        np.stack((st, ct * ca, -ct * sa, a * st), axis=-1),
+        np.stack((zero, sa, ca, d), axis=-1),
+        np.stack((zero, zero, zero, one), axis=-1),
+    ), axis=-2)
+
+def forward_kinematics(joint_angles, tool_transform=GRIPPER_TOOL_TRANSFORM, dh=None):
+    """Tool poses of Gen3 joint configurations
+
+    Arguments:
+    joint_angles -- (N, dof) or (dof,) joint angles (deg), dof = 6 or 7
+    tool_transform -- (x, y, z, theta_x, theta_y, theta_z) of the tool in the interface frame, as in the tool configuration
+    dh -- (dof, 4) DH parameters, by default GEN3_DH[dof]
+
+    Returns (N, 6) or (6,) poses (x, y, z in m, theta_x, theta_y, theta_z in
+    deg), in the convention of the base feedback and ComputeForwardKinematics.
+    """
+    joint_angles = np.asarray(joint_angles, dtype=np.float64)
+    angles = np.atleast_2d(joint_angles)
+    dh = GEN3_DH[angles.shape[1]] if dh is None else np.asarray(dh, dtype=np.float64)
+
+    # (N, dof, 4, 4) joint transforms, chained one joint at a time over the whole batch
+    joints = dh_transforms(dh[:, 0], dh[:, 1], dh[:, 2], np.radians(angles) + dh[:, 3])
+    matrices = np.broadcast_to(dh_transforms(np.pi, 0.0, 0.0, 0.0), (len(angles), 4, 4))
+    for joint in range(angles.shape[1]):
+        matrices = matrices @ joints[:, joint]
+    if tool_transform is not None:
+        matrices = matrices @ pose_matrices(tool_transform)
+
+    poses = matrix_poses(matrices)
+    return poses[0] if joint_angles.ndim == 1 else poses
+
+def sample_joint_angles(count, dof=7, margin=0.9, rng=None):
+    """(count, dof) random joint angles (deg, in [0, 360)) within margin times the joint limits"""
+    rng = np.random.default_rng() if rng is None else rng
+    limits = np.array([360.0 if limit is None else margin * limit for limit in GEN3_JOINT_LIMITS[dof]])
+    angles = rng.uniform(-1.0, 1.0, (count, dof)) * np.minimum(limits, 180.0)
+    return angles % 360.0
+
+def validate(base, tool_transform, dof=7, samples=100, rng=None):
+    """Compare forward_kinematics with base.ComputeForwardKinematics on random configurations
+
+    Returns the (N,) position errors (m) and orientation errors (deg).
+    """
+    from kortex_api.autogen.messages import Base_pb2
+    from motion_timing import rotation_angle
+
+    angles = sample_joint_angles(samples, dof, rng=rng)
+
+    started = time.perf_counter()
+    remote = []
+    for configuration in angles:
+        joint_angles = Base_pb2.JointAngles()
+        for joint_id, value in enumerate(configuration):
+            joint_angle = joint_angles.joint_angles.add()
+            joint_angle.joint_identifier = joint_id
+            joint_angle.value = value
+        pose = base.ComputeForwardKinematics(joint_angles)
+        remote.append((pose.x, pose.y, pose.z, pose.theta_x, pose.theta_y, pose.theta_z))
+    remote_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    local = forward_kinematics(angles, tool_transform)
+    local_time = time.perf_counter() - started
+
+    remote = np.array(remote)
+    position_errors = np.linalg.norm(local[:, :3] - remote[:, :3], axis=1)
+    orientation_errors = rotation_angle(local[:, 3:], remote[:, 3:])
+    print("{} configurations of {} joints".format(samples, dof))
+    print("ComputeForwardKinematics: {:.1f} ms per pose".format(remote_time / samples * 1000))
+    print("forward_kinematics: {:.4f} ms per pose".format(local_time / samples * 1000))
+    print("Position error: max {:.3f} mm, mean {:.3f} mm".format(position_errors.max() * 1000, position_errors.mean() * 1000))
+    print("Orientation error: max {:.3f} deg, mean {:.3f} deg".format(orientation_errors.max(), orientation_errors.mean()))
+    return position_errors, orientation_errors
+
+def main():
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+    import utilities
+    from kortex_api.autogen.client_stubs.BaseClientRpc import BaseClient
+    from kortex_api.autogen.client_stubs.ControlConfigClientRpc import ControlConfigClient
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["validate"], help="compare with ComputeForwardKinematics on the robot")
+    parser.add_argument("--samples", type=int, default=100, help="number of random joint configurations")
+    args = utilities.parseConnectionArguments(parser)
+
+    with utilities.DeviceConnection.createTcpConnection(args) as router:
+        base = BaseClient(router)
+        tool = ControlConfigClient(router).GetToolConfiguration().tool_transform
+        tool_transform = (tool.x, tool.y, tool.z, tool.theta_x, tool.theta_y, tool.theta_z)
+        position_errors, orientation_errors = validate(base, tool_transform, utilities.device_metadata(router).actuator_count, args.samples)
+
+    # Beyond the rounding of the poses returned by the robot
+    return 0 if position_errors.max() < 1e-3 and orientation_errors.max() < 0.1 else 1
+
+if __name__ == "__main__":
+    exit(main())
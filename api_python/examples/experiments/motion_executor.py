@@ -0,0 +1,133 @@
+#! /usr/bin/env python3
+
+###
+# KINOVA (R) KORTEX (TM)
+#
+# Copyright (c) 2018 Kinova inc. All rights reserved.
+#
+# This software may be modified and distributed
+# under the terms of the BSD 3-Clause license.
+#
+# Refer to the LICENSE file for details.
+#
+###
+
+import collections
+import itertools
+import os
+import sys
+import threading
+from concurrent.futures import Future, TimeoutError
+
+from kortex_api.autogen.messages import Base_pb2
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import utilities
+
+class MotionExecutor:
+    """Run base actions with one notification subscription for the whole session
+
+    Every executed action gets a concurrent.futures.Future resolved by its
+    ACTION_END (True) or ACTION_ABORT (False) notification. Notifications are
+    matched by action handle identifier for actions executed from a reference;
+    ExecuteAction and ExecuteWaypointTrajectory return no handle, so their
+    notifications resolve the oldest pending action. The base runs one action
+    at a time (a new one aborts the previous), so that order is the one the
+    notifications arrive in.
+    """
+
+    def __init__(self, base):
+        self.base = base
+        self.lock = threading.Lock()
+        self.pending = collections.OrderedDict() # key -> Future, oldest first
+        self.keys = itertools.count()
+        self.stats = collections.Counter() # 'executed' and 'skipped' moves
+        self.notification_handle = base.OnNotificationActionTopic(self._on_action, Base_pb2.NotificationOptions())
+
+    def close(self):
+        if self.notification_handle is None:
+            return
+        self.base.Unsubscribe(self.notification_handle)
+        self.notification_handle = None
+        with self.lock:
+            pending, self.pending = list(self.pending.values()), collections.OrderedDict()
+        for future in pending:
+            future.cancel()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _on_action(self, notification):
+        if notification.action_event not in (Base_pb2.ACTION_END, Base_pb2.ACTION_ABORT):
+            return
+        with self.lock:
+            future = self.pending.pop(('handle', notification.handle.identifier), None)
+            if future is None and self.pending:
+                _, future = self.pending.popitem(last=False)
+        if future is None:
+            return
+
+        if notification.action_event == Base_pb2.ACTION_ABORT:
+            print("Action aborted with error {}:{}".format(
+                notification.abort_details, Base_pb2.SubErrorCodes.Name(notification.abort_details)))
+        if future.set_running_or_notify_cancel():
+            future.set_result(notification.action_event == Base_pb2.ACTION_END)
+
+    def _submit(self, key, execute, request):
+        # Register before executing: the END notification can beat the RPC reply
+        future = Future()
+        with self.lock:
+            self.pending[key] = future
+            self.stats['executed'] += 1
+        try:
+            execute(request)
+        except Exception:
+            with self.lock:
+                self.pending.pop(key, None)
+                self.stats['executed'] -= 1
+            raise
+        return future
+
+    def execute_action(self, action):
+        """ExecuteAction, returning the Future of its completion"""
+        return self._submit(('action', next(self.keys)), self.base.ExecuteAction, action)
+
+    def execute_action_from_reference(self, action_handle):
+        """ExecuteActionFromReference, returning the Future of its completion"""
+        return self._submit(('handle', action_handle.identifier), self.base.ExecuteActionFromReference, action_handle)
+
+    def execute_waypoint_trajectory(self, waypoint_list):
+        """ExecuteWaypointTrajectory, returning the Future of its completion"""
+        return self._submit(('action', next(self.keys)), self.base.ExecuteWaypointTrajectory, waypoint_list)
+
+    def skip(self):
+        """Count a move left out because the arm already was at its target"""
+        with self.lock:
+            self.stats['skipped'] += 1
+
+    def wait(self, future, timeout):
+        """Wait for an action Future; False on abort or timeout
+
+        A timed out action stays pending, so that its late notification does
+        not resolve the next action instead.
+        """
+        try:
+            return future.result(timeout)
+        except TimeoutError:
+            print("Timeout on action notification wait")
+            return False
+
+_executors = utilities.SessionRegistry(MotionExecutor)
+
+def motion_executor(base):
+    """The session MotionExecutor of a BaseClient, subscribed on first use"""
+    return _executors.get(base)
+
+def close_motion_executor(base):
+    """Unsubscribe the session MotionExecutor of a BaseClient, if any"""
+    executor = _executors.pop(base)
+    if executor is not None:
+        executor.close()
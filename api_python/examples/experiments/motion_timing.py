@@ -0,0 +1,254 @@
+#! /usr/bin/env python3
+
+# Estimate how long a sequence of robot actions takes before running it, and
+# calibrate the estimate against logged executions.
+#
+# usage: python3 motion_timing.py calibrate motion_log.jsonl [--output motion_limits.json]
+
+import argparse
+import json
+import os
+
+import numpy as np
+
+from kinematics import forward_kinematics, rotation_matrices, GEN3_DH
+
+# Velocity and acceleration limits, and fixed costs, of the timing model
+MOTION_LIMITS = {
+    'linear_speed': 0.1, # m/s, cartesian translation
+    'linear_accel': 0.5, # m/s^2
+    'angular_speed': 30.0, # deg/s, cartesian rotation
+    'angular_accel': 90.0, # deg/s^2
+    'joint_speed': 30.0, # deg/s, slowest joint of an angular action
+    'joint_accel': 90.0, # deg/s^2
+    'overhead': 0.3, # s per action (request and END notification round trip)
+    'settle': 0.2, # s per stop of the arm
+    'gripper': 1.0, # s per gripper command
+}
+# Limits fitted by calibrate_limits, loaded by load_limits when present
+MOTION_LIMITS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'motion_limits.json')
+CALIBRATED_LIMITS = ('linear_speed', 'linear_accel', 'angular_speed', 'angular_accel',
+                     'joint_speed', 'joint_accel', 'overhead', 'settle', 'gripper')
+
+# Gen3 7 DOF "Home" action, as joint angles and as the tool pose it reaches
+HOME_JOINT_ANGLES = (0, 15, 180, 230, 0, 55, 90)
+HOME_POSE = (0.576, 0.001, 0.434, 90, 0, 90)
+
+def load_limits(path=MOTION_LIMITS_FILE):
+    """MOTION_LIMITS updated with the calibrated values saved at path, if any"""
+    limits = dict(MOTION_LIMITS)
+    if os.path.exists(path):
+        with open(path) as f:
+            limits.update(json.load(f))
+    return limits
+
+def trapezoid_time(distance, max_speed, max_accel):
+    """Duration of rest-to-rest moves with a trapezoidal velocity profile
+
+    Moves too short to reach max_speed follow a triangular profile.
+    Works elementwise on arrays.
+    """
+    distance = np.abs(np.asarray(distance, dtype=np.float64))
+    ramp = max_speed * max_speed / max_accel # distance spent accelerating and braking
+    return np.where(distance < ramp,
+                    2.0 * np.sqrt(distance / max_accel),
+                    distance / max_speed + max_speed / max_accel)
+
+def rotation_angle(thetas_a, thetas_b):
+    """Angle (deg) of the rotation between two sets of (theta_x, theta_y, theta_z) orientations"""
+    ra = rotation_matrices(np.atleast_2d(thetas_a))
+    rb = rotation_matrices(np.atleast_2d(thetas_b))
+    trace = np.einsum('nij,nij->n', ra, rb)
+    return np.degrees(np.arccos(np.clip((trace - 1.0) / 2.0, -1.0, 1.0)))
+
+def cartesian_move_times(poses, start, limits=MOTION_LIMITS):
+    """Motion time (s) of each stop-to-stop cartesian move along a pose sequence
+
+    Arguments:
+    poses -- (N, 6) target poses (x, y, z in m, theta_x, theta_y, theta_z in deg)
+    start -- pose the arm is at before the first move
+    limits -- dict of MOTION_LIMITS
+
+    Translation and rotation are synchronized, so a move lasts as long as the
+    slower of the two. Fixed costs are not included: this is the cost function
+    for plan optimizers, vectorized over the whole sequence.
+    """
+    poses = np.atleast_2d(np.asarray(poses, dtype=np.float64))
+    previous = np.vstack((np.asarray(start, dtype=np.float64), poses[:-1]))
+    translation = np.linalg.norm(poses[:, :3] - previous[:, :3], axis=1)
+    rotation = rotation_angle(previous[:, 3:], poses[:, 3:])
+    return np.maximum(trapezoid_time(translation, limits['linear_speed'], limits['linear_accel']),
+                      trapezoid_time(rotation, limits['angular_speed'], limits['angular_accel']))
+
+def joint_move_times(joint_angles, start, limits=MOTION_LIMITS):
+    """Motion time (s) of each angular move along a sequence of joint targets
+
+    Joints move synchronized, so a move lasts as long as its largest joint
+    rotation; angles are compared the short way around.
+    """
+    joint_angles = np.atleast_2d(np.asarray(joint_angles, dtype=np.float64))
+    previous = np.vstack((np.asarray(start, dtype=np.float64), joint_angles[:-1]))
+    delta = (joint_angles - previous + 180.0) % 360.0 - 180.0
+    return trapezoid_time(np.abs(delta).max(axis=1), limits['joint_speed'], limits['joint_accel'])
+
+def waypoint_trajectory_time(waypoints, start, limits=MOTION_LIMITS):
+    """Motion time (s) of a cartesian waypoint trajectory, with settling
+
+    Arguments:
+    waypoints -- (x, y, z, blending_radius, theta_x, theta_y, theta_z) tuples, as in 110-Waypoints
+    start -- pose the arm is at before the trajectory
+
+    The arm only stops on waypoints with a zero blending radius (always the
+    last one); between two stops, blended waypoints are passed at speed, so
+    each piece is timed as one trapezoidal move over its path length.
+    """
+    waypoints = np.atleast_2d(np.asarray(waypoints, dtype=np.float64))
+    poses = waypoints[:, [0, 1, 2, 4, 5, 6]]
+    previous = np.vstack((np.asarray(start, dtype=np.float64), poses[:-1]))
+    translation = np.linalg.norm(poses[:, :3] - previous[:, :3], axis=1)
+    rotation = rotation_angle(previous[:, 3:], poses[:, 3:])
+
+    stops = waypoints[:, 3] == 0.0
+    stops[-1] = True
+    piece = np.concatenate(([0], np.cumsum(stops)[:-1]))
+    num_pieces = int(stops.sum())
+    translation = np.bincount(piece, translation, num_pieces)
+    rotation = np.bincount(piece, rotation, num_pieces)
+    times = np.maximum(trapezoid_time(translation, limits['linear_speed'], limits['linear_accel']),
+                       trapezoid_time(rotation, limits['angular_speed'], limits['angular_accel']))
+    return float(times.sum()) + num_pieces * limits['settle']
+
+def action_time(kind, target, start=None, limits=MOTION_LIMITS):
+    """Duration (s) of one action, fixed costs included
+
+    Arguments:
+    kind -- 'cartesian' (pose), 'joint' (joint angles), 'home' (no target),
+        'waypoints' (list of waypoint tuples), 'gripper' (position) or 'wait' (seconds)
+    target -- target of the action
+    start -- pose ('cartesian', 'waypoints') or joint angles ('joint', 'home')
+        the arm is at before the action; None leaves the move to the first
+        target out of the estimate
+    """
+    if kind == 'wait':
+        return float(target)
+    if kind == 'gripper':
+        return limits['gripper']
+    if kind == 'waypoints':
+        if start is None:
+            # Time the trajectory from its first waypoint
+            start = [target[0][k] for k in (0, 1, 2, 4, 5, 6)]
+        return limits['overhead'] + waypoint_trajectory_time(target, start, limits)
+
+    if kind == 'home':
+        kind, target = 'joint', HOME_JOINT_ANGLES
+    if kind not in ('cartesian', 'joint'):
+        raise ValueError(f'unknown action kind {kind!r}')
+    if start is None:
+        motion = 0.0
+    elif kind == 'cartesian':
+        motion = float(cartesian_move_times([target], start, limits)[0])
+    else:
+        motion = float(joint_move_times([target], start, limits)[0])
+    return limits['overhead'] + motion + limits['settle']
+
+def estimate_motion_time(actions, start_pose=None, start_joints=HOME_JOINT_ANGLES, limits=MOTION_LIMITS):
+    """Predict the duration of a sequence of actions
+
+    Arguments:
+    actions -- (kind, target) pairs, see action_time
+    start_pose -- tool pose before the first action (None = unknown)
+    start_joints -- joint angles before the first action (None = unknown)
+    limits -- dict of MOTION_LIMITS, e.g. from load_limits()
+
+    The arm state is tracked from action to action. An angular action of a
+    Gen3 reaches the tool pose given by forward_kinematics (with the gripper
+    tool transform), but a cartesian action leaves the joint angles unknown,
+    so a joint move from there only counts its fixed costs and the total is
+    then a lower bound.
+
+    Returns the (N,) duration of every action and the total, in seconds.
+    """
+    pose, joints = start_pose, start_joints
+    times = np.zeros(len(actions))
+    for i, (kind, target) in enumerate(actions):
+        if kind in ('cartesian', 'waypoints'):
+            times[i] = action_time(kind, target, pose, limits)
+            pose = target if kind == 'cartesian' else [target[-1][k] for k in (0, 1, 2, 4, 5, 6)]
+            joints = None
+        elif kind in ('joint', 'home'):
+            times[i] = action_time(kind, target, joints, limits)
+            joints = HOME_JOINT_ANGLES if kind == 'home' else target
+            pose = HOME_POSE if kind == 'home' else forward_kinematics(target) if len(target) in GEN3_DH else None
+        else:
+            times[i] = action_time(kind, target, None, limits)
+    return times, float(times.sum())
+
+class MotionLog:
+    """JSON lines log of executed actions and their measured duration, for calibrate_limits"""
+
+    def __init__(self, path):
+        self.file = open(path, 'a')
+
+    def record(self, kind, target, start, duration):
+        target = np.asarray(target, dtype=np.float64).tolist() if target is not None else None
+        start = np.asarray(start, dtype=np.float64).tolist() if start is not None else None
+        self.file.write(json.dumps({'kind': kind, 'target': target, 'start': start, 'duration': duration}) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def load_motion_log(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def calibrate_limits(records, limits=MOTION_LIMITS):
+    """Fit the CALIBRATED_LIMITS of the timing model to logged executions
+
+    Arguments:
+    records -- dicts with 'kind', 'target', 'start' and the measured 'duration'
+    limits -- starting point of the fit; limits no record depends on keep it
+
+    Minimizes the squared timing error (s) over the logarithms of the
+    limits, so every fitted limit stays positive. Returns the fitted limits
+    dict.
+    """
+    from scipy.optimize import least_squares
+
+    records = [r for r in records if r['kind'] != 'wait']
+    measured = np.array([r['duration'] for r in records], dtype=np.float64)
+
+    def fitted(log_values):
+        return dict(limits, **dict(zip(CALIBRATED_LIMITS, np.exp(log_values))))
+
+    def residuals(log_values):
+        trial = fitted(log_values)
+        return np.array([action_time(r['kind'], r['target'], r['start'], trial) for r in records]) - measured
+
+    initial = np.log([limits[name] for name in CALIBRATED_LIMITS])
+    result = least_squares(residuals, initial)
+    print(f'rms timing error: {np.sqrt(np.mean(residuals(initial) ** 2)):.3f} s -> {np.sqrt(np.mean(result.fun ** 2)):.3f} s')
+    return fitted(result.x)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['calibrate'])
+    parser.add_argument('log', help='motion log written by MotionLog')
+    parser.add_argument('--output', type=str, default=MOTION_LIMITS_FILE, help='where to save the fitted limits')
+    args = parser.parse_args()
+
+    limits = calibrate_limits(load_motion_log(args.log), load_limits())
+    for name in CALIBRATED_LIMITS:
+        print(f'{name:<14}{limits[name]:>10.3f}')
+    with open(args.output, 'w') as f:
+        json.dump({name: float(limits[name]) for name in CALIBRATED_LIMITS}, f, indent=2)
+    print(f'saved {args.output}')
+
+if __name__ == '__main__':
+    main()
@@ -15,8 +15,17 @@
 import time
 import sys
 import os
-import threading
+import contextlib
 from painting_utils import *
+from tiled_painting import plan_painting_tiled
+from motion_timing import estimate_motion_time, load_limits, MotionLog
+from motion_executor import motion_executor
+from action_registry import action_registry
+from gripper import GripperController, GRIPPER_TIMEOUT
+from feedback_cache import feedback_cache, running_feedback_cache
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import utilities
 
 from kortex_api.autogen.client_stubs.BaseClientRpc import BaseClient
 from kortex_api.autogen.client_stubs.BaseCyclicClientRpc import BaseCyclicClient
@@ -28,51 +37,18 @@ from kortex_api.autogen.messages import Session_pb2, Base_pb2
 # Maximum allowed waiting time during actions (in seconds)
 TIMEOUT_DURATION = 10
 
-# Create closure to set an event after an END or an ABORT
-def check_for_sequence_end_or_abort(e):
-    """Return a closure checking for END or ABORT notifications on a sequence
-
-    Arguments:
-    e -- event to signal when the action is completed
-        (will be set when an END or ABORT occurs)
-    """
-
-    def check(notification, e = e):
-        event_id = notification.event_identifier
-        task_id = notification.task_index
-        if event_id == Base_pb2.SEQUENCE_TASK_COMPLETED:
-            print("Sequence task {} completed".format(task_id))
-        elif event_id == Base_pb2.SEQUENCE_ABORTED:
-            print("Sequence aborted with error {}:{}"\
-                .format(\
-                    notification.abort_details,\
-                    Base_pb2.SubErrorCodes.Name(notification.abort_details)))
-            e.set()
-        elif event_id == Base_pb2.SEQUENCE_COMPLETED:
-            print("Sequence completed.")
-            e.set()
-    return check
-
-# Create closure to set an event after an END or an ABORT
-def check_for_end_or_abort(e):
-    """Return a closure checking for END or ABORT notifications
-
-    Arguments:
-    e -- event to signal when the action is completed
-        (will be set when an END or ABORT occurs)
-    """
-    def check(notification, e = e):
-        print("EVENT : " + \
-              Base_pb2.ActionEvent.Name(notification.action_event))
-        if notification.action_event == Base_pb2.ACTION_END \
-        or notification.action_event == Base_pb2.ACTION_ABORT:
-            e.set()
-    return check
+# Height of the brush above the paper or the paint pot during travel (m)
+LIFT_HEIGHT = 0.05
+# Blending radius of lifted travel waypoints in stroke trajectories (m)
+TRAVEL_BLENDING_RADIUS = 0.01
+# Largest blending radius as a fraction of the distance to the nearest
+# neighbouring waypoint; under 1/2 so that neighbouring blend zones never meet
+BLENDING_GAP_FRACTION = 0.45
 
 #
 # Example related functions
 #
-def example_move_to_home_position(base):
+def example_move_to_home_position(base, base_cyclic=None):
     # Make sure the arm is in Single Level Servoing mode
     base_servo_mode = Base_pb2.ServoingModeInformation()
     base_servo_mode.servoing_mode = Base_pb2.SINGLE_LEVEL_SERVOING
@@ -80,63 +56,46 @@ def example_move_to_home_position(base):
     
     # Move arm to ready position
     print("Moving the arm to a safe position")
-    action_type = Base_pb2.RequestedActionType()
-    action_type.action_type = Base_pb2.REACH_JOINT_ANGLES
-    action_list = base.ReadAllActions(action_type)
-    action_handle = None
-    for action in action_list.action_list:
-        if action.name == "Home":
-            action_handle = action.handle
-
-    if action_handle == None:
+    action = action_registry(base).action("Home", Base_pb2.REACH_JOINT_ANGLES)
+
+    if action == None:
         print("Can't reach safe position. Exiting")
         sys.exit(0)
 
-    e = threading.Event()
-    notification_handle = base.OnNotificationActionTopic(
-        check_for_end_or_abort(e),
-        Base_pb2.NotificationOptions()
-    )
-
-    base.ExecuteActionFromReference(action_handle)
-
-    # Leave time to action to complete # TODO timing out here!!
-    finished = e.wait(TIMEOUT_DURATION)
-    base.Unsubscribe(notification_handle)
-    
-    if not finished:
-        print("Timeout on action notification wait")
+    executor = motion_executor(base)
+    home_angles = [joint_angle.value for joint_angle in action.reach_joint_angles.joint_angles.joint_angles]
+    # Only checked while a feedback cache runs, no thread is started for it
+    cache = running_feedback_cache(base_cyclic) if base_cyclic is not None else None
+    if cache is not None and cache.at_joint_angles(home_angles):
+        print("Already at the safe position")
+        executor.skip()
+        return True
+    future = executor.execute_action_from_reference(action.handle)
+
+    # Leave time to action to complete
+    finished = executor.wait(future, TIMEOUT_DURATION)
     return finished
 
 class GripperCommandExample:
-    def __init__(self, router, proportional_gain = 2.0):
+    def __init__(self, router, proportional_gain = 2.0, base_cyclic = None):
 
         self.proportional_gain = proportional_gain
         self.router = router
 
         # Create base client using TCP router
         self.base = BaseClient(self.router)
-
-    def ExampleSendGripperCommands(self, base, position):
-
-        # Create the GripperCommand we will send
-        gripper_command = Base_pb2.GripperCommand()
-        finger = gripper_command.gripper.finger.add()
-
-        # e = threading.Event()
-        # notification_handle = base.OnNotificationActionTopic(
-        #     check_for_end_or_abort(e),
-        #     Base_pb2.NotificationOptions()
-        # )
-
-        # Close the gripper with position increments
-        print("Performing gripper test in position...")
-        gripper_command.mode = Base_pb2.GRIPPER_POSITION
-        finger.finger_identifier = 1
-        finger.value = position
-        print("Going to position {:0.2f}...".format(finger.value))
-        self.base.SendGripperCommand(gripper_command)
-        time.sleep(1) # necessary, gives gripper time to move
+        self.base_cyclic = base_cyclic or BaseCyclicClient(self.router)
+        self.controller = GripperController(self.base, self.base_cyclic)
+
+    def ExampleSendGripperCommands(self, base, position, timeout=GRIPPER_TIMEOUT):
+        # Returns once the fingers reach the position or stall on an object
+        print("Going to position {:0.2f}...".format(position))
+        return self.controller.move(position, timeout)
+
+    def SendGripperCommandAsync(self, position, timeout=GRIPPER_TIMEOUT):
+        # Returns a Future resolved once the fingers reach the position or stall
+        print("Going to position {:0.2f}...".format(position))
+        return self.controller.move_async(position, timeout)
         
 
 
@@ -147,30 +106,23 @@ def angular_action(base, joint_angles):
     action.name = "Example angular action movement"
     action.application_data = ""
 
-    actuator_count = base.GetActuatorCount()
-    
-    for joint_id in range(actuator_count.count):
+    # Read once per session
+    actuator_count = utilities.device_metadata(base.router).actuator_count
+
+    for joint_id in range(actuator_count):
         joint_angle = action.reach_joint_angles.joint_angles.joint_angles.add()
         joint_angle.joint_identifier = joint_id
         joint_angle.value = joint_angles[joint_id]
 
-    e = threading.Event()
-    notification_handle = base.OnNotificationActionTopic(
-        check_for_end_or_abort(e),
-        Base_pb2.NotificationOptions()
-    )
-    
+    executor = motion_executor(base)
     print("Executing action")
-    base.ExecuteAction(action)
+    future = executor.execute_action(action)
 
     print("Waiting for movement to finish ...")
-    finished = e.wait(TIMEOUT_DURATION)
-    base.Unsubscribe(notification_handle)
+    finished = executor.wait(future, TIMEOUT_DURATION)
 
     if finished:
         print("Angular movement completed")
-    else:
-        print("Timeout on action notification wait")
     return finished
 
 def cartesian_action(base, base_cyclic, pose):
@@ -181,8 +133,6 @@ def cartesian_action(base, base_cyclic, pose):
     action.name = "Example Cartesian action movement"
     action.application_data = ""
 
-    feedback = base_cyclic.RefreshFeedback()
-
     cartesian_pose = action.reach_pose.target_pose
     cartesian_pose.x = x #feedback.base.tool_pose_x          # (meters)
     cartesian_pose.y = y #feedback.base.tool_pose_y - 0.1    # (meters)
@@ -191,37 +141,172 @@ def cartesian_action(base, base_cyclic, pose):
     cartesian_pose.theta_y = theta_y # (degrees)
     cartesian_pose.theta_z = theta_z # (degrees)
 
-    e = threading.Event()
-    notification_handle = base.OnNotificationActionTopic(
-        check_for_end_or_abort(e),
-        Base_pb2.NotificationOptions()
-    )
-
+    executor = motion_executor(base)
+    cache = running_feedback_cache(base_cyclic)
+    if cache is not None and cache.at_pose(pose):
+        print("Already at the target pose")
+        executor.skip()
+        return True
     print("Executing action")
-    base.ExecuteAction(action)
+    future = executor.execute_action(action)
 
     print("Waiting for movement to finish ...")
-    finished = e.wait(TIMEOUT_DURATION)
-    base.Unsubscribe(notification_handle)
+    finished = executor.wait(future, TIMEOUT_DURATION)
 
     if finished:
         print("Cartesian movement completed")
-    else:
-        print("Timeout on action notification wait")
+    return finished
+
+
+def populateCartesianCoordinate(waypointInformation):
+    
+    waypoint = Base_pb2.CartesianWaypoint()  
+    waypoint.pose.x = waypointInformation[0]
+    waypoint.pose.y = waypointInformation[1]
+    waypoint.pose.z = waypointInformation[2]
+    waypoint.blending_radius = waypointInformation[3]
+    waypoint.pose.theta_x = waypointInformation[4]
+    waypoint.pose.theta_y = waypointInformation[5]
+    waypoint.pose.theta_z = waypointInformation[6] 
+    waypoint.reference_frame = Base_pb2.CARTESIAN_REFERENCE_FRAME_BASE
+    
+    return waypoint
+
+def lifted(pose, lift=LIFT_HEIGHT):
+    return (pose[0], pose[1], pose[2] + lift, pose[3], pose[4], pose[5])
+
+def waypoint_definition(pose, blending_radius=0.0):
+    # (x, y, z, blending_radius, theta_x, theta_y, theta_z), as in 110-Waypoints
+    return (pose[0], pose[1], pose[2], blending_radius, pose[3], pose[4], pose[5])
+
+def limit_blending_radii(run, fraction=BLENDING_GAP_FRACTION):
+    """Return a run whose blending radii stay under fraction times the distance to the neighbouring waypoints
+
+    The base rejects a trajectory whose blend zones overlap each other or a
+    waypoint (TRAJECTORY_ERROR_TYPE_INVALID_BLENDING_RADIUS), which happens
+    when the lifted ends of adjacent strokes are a pixel apart. Waypoints on
+    top of their neighbour get no blending.
+    """
+    points = np.array([waypoint[:3] for waypoint in run], dtype=np.float64)
+    gaps = np.linalg.norm(np.diff(points, axis=0), axis=1)
+    nearest = np.full(len(run), np.inf)
+    nearest[:-1] = gaps
+    nearest[1:] = np.minimum(nearest[1:], gaps)
+    radii = np.minimum([waypoint[3] for waypoint in run], fraction * nearest)
+    return [waypoint[:3] + (float(radius),) + waypoint[4:] for waypoint, radius in zip(run, radii)]
+
+def compile_stroke_runs(poses, color_ids, dips, color_positions, blending_radius=TRAVEL_BLENDING_RADIUS):
+    """Return one list of waypoint definitions per dip
+
+    Arguments:
+    poses -- (N, 2, 6) stroke start and end poses from painting()
+    color_ids -- color id of every stroke
+    dips -- dip flags from painting(), one per stroke
+    color_positions -- paint pot pose per color id (None = color is skipped)
+    blending_radius -- blending radius (m) given to the lifted travel waypoints, limited by limit_blending_radii
+
+    Each run dips the brush and paints every stroke until the next dip.
+    Waypoints touching the pot or the paper keep a zero blending radius so the
+    brush really reaches them; only the lifted travel waypoints are blended.
+    A stroke starting where the previous one ended (contour rings) is painted
+    without lifting the brush.
+
+    Returns the runs and, for each run, the index of the last stroke it paints.
+    """
+    runs = []
+    last_strokes = []
+    run = None
+    previous_end = None
+    for i, ((start_pos, end_pos), color, dip) in enumerate(zip(poses, color_ids, dips)):
+        color_pos = color_positions[color]
+        if color_pos is None:
+            previous_end = None
+            continue
+
+        if dip:
+            run = []
+            runs.append(run)
+            last_strokes.append(i)
+            run.append(waypoint_definition(lifted(color_pos), blending_radius))
+            run.append(waypoint_definition(color_pos))
+            run.append(waypoint_definition(lifted(color_pos), blending_radius))
+        elif run is None:
+            # The brush still holds paint from the previous batch
+            run = []
+            runs.append(run)
+            last_strokes.append(i)
+        elif previous_end is not None and np.array_equal(start_pos, previous_end):
+            # Replace the lift after the previous stroke with this one
+            run.pop()
+            run.append(waypoint_definition(end_pos))
+            run.append(waypoint_definition(lifted(end_pos), blending_radius))
+            previous_end = end_pos
+            last_strokes[-1] = i
+            continue
+
+        run.append(waypoint_definition(lifted(start_pos), blending_radius))
+        run.append(waypoint_definition(start_pos))
+        run.append(waypoint_definition(end_pos))
+        run.append(waypoint_definition(lifted(end_pos), blending_radius))
+        previous_end = end_pos
+        last_strokes[-1] = i
+
+    # The arm has to stop on the last waypoint of a trajectory
+    for run in runs:
+        run[-1] = run[-1][:3] + (0.0,) + run[-1][4:]
+    return [limit_blending_radii(run) for run in runs], last_strokes
+
+def execute_waypoint_trajectory(base, waypointsDefinition):
+
+    waypoints = Base_pb2.WaypointList()
+    waypoints.duration = 0.0
+    waypoints.use_optimal_blending = False
+
+    for index, waypointDefinition in enumerate(waypointsDefinition):
+        waypoint = waypoints.waypoints.add()
+        waypoint.name = "waypoint_" + str(index)
+        waypoint.cartesian_waypoint.CopyFrom(populateCartesianCoordinate(waypointDefinition))
+
+    # Verify validity of waypoints
+    result = base.ValidateWaypointList(waypoints)
+    if len(result.trajectory_error_report.trajectory_error_elements) != 0:
+        print("Error found in trajectory")
+        result.trajectory_error_report.PrintDebugString()
+        return False
+
+    executor = motion_executor(base)
+    print("Moving cartesian trajectory ({} waypoints)...".format(len(waypointsDefinition)))
+    future = executor.execute_waypoint_trajectory(waypoints)
+
+    print("Waiting for trajectory to finish ...")
+    finished = executor.wait(future, TIMEOUT_DURATION * len(waypointsDefinition))
+
+    if finished:
+        print("Cartesian trajectory completed")
     return finished
 
 
 def main():
-    # Import the utilities helper module
     import argparse
-    sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
-    import utilities
 
     # Parse arguments
     parser = argparse.ArgumentParser()
-    args = utilities.parseConnectionArguments()
+    parser.add_argument("--stream", action="store_true", help="start painting while the rest of the plan is computed (no preview)")
+    parser.add_argument("--tiled", action="store_true", help="plan strip by strip with bounded memory (large canvases; the image must be a .npy from tiled_painting.convert_source to be read lazily)")
+    parser.add_argument("--plan", type=str, help="execute a plan saved with --save-plan instead of planning")
+    parser.add_argument("--cache", action="store_true", help="reuse color quantizations cached under ~/.cache/kinova_painting")
+    parser.add_argument("--save-plan", type=str, help="save the computed plan to this .npz file")
+    parser.add_argument("--journal", type=str, default="painting.journal", help="progress journal written while painting")
+    parser.add_argument("--resume", action="store_true", help="skip the strokes completed in --journal and re-dip before continuing")
+    parser.add_argument("--motion-log", type=str, help="log trajectory durations for motion_timing.py calibrate")
+    args = utilities.parseConnectionArguments(parser)
 
     ROBOT_ORIGIN = (0.61, 0.195, .063, 90, 0, 90) # bottom left corner of paper
+    # Touch off the brush on the canvas corners (in canvas_corners() order) and
+    # list the measured poses here to replace the axis-aligned ROBOT_ORIGIN mapping
+    CANVAS_CORNER_POSES = None
+    if CANVAS_CORNER_POSES is not None:
+        ROBOT_ORIGIN = estimate_canvas_transform(canvas_corners(), CANVAS_CORNER_POSES)
     # hover ~5cm above actual colors
     COLOR1_POS = (0.652, -0.067, 0.07, 90, 0, 90) # top left
     COLOR2_POS = (0.614, -0.067, 0.07, 90, 0, 90) # middle left
@@ -229,71 +314,96 @@ def main():
     COLOR4_POS = (0.652, -0.116, 0.07, 90, 0, 90) # top right
     COLOR5_POS = (0.614, -0.116, 0.07, 90, 0, 90) # middle right
     COLOR6_POS = (0.573, -0.116, 0.07, 90, 0, 90) # bottom right
+    # paint pot per color id, None = skip that color (white)
+    color_positions = [COLOR1_POS, None, COLOR3_POS, COLOR4_POS]
     
     # Painting
     image_path = 'stanford_logo.png'
     save_path = 'stanford_painting.png'
-    brushstrokes, colors = painting(image_path, save_path, ROBOT_ORIGIN)
+    plan = load_plan(args.plan) if args.plan else None
+    num_colors = len(plan['colors']) if plan is not None else NUM_COLORS
+    if len(color_positions) < num_colors:
+        print("ERROR: color not found ({} colors, {} paint positions)".format(num_colors, len(color_positions)))
+        return 1
+
+    if plan is not None:
+        batches = [plan]
+    elif args.stream:
+        # Planned batches are produced on a background thread as the arm paints
+        batches = prefetch(iter_plan_batches(image_path, ROBOT_ORIGIN, use_cache=args.cache))
+    elif args.tiled:
+        batches = [plan_painting_tiled(image_path, ROBOT_ORIGIN)]
+    else:
+        batches = [painting(image_path, save_path, ROBOT_ORIGIN, use_cache=args.cache)]
+    if args.save_plan and not args.stream:
+        save_plan(args.save_plan, batches[0])
+    # Resuming needs the same plan: prefer --plan, or a deterministic planner
+    if plan is not None:
+        parameters = {name: plan['metadata'].get(name) for name in planning_parameters()}
+        parameters['image_hash'] = plan['image_hash']
+    else:
+        parameters = dict(planning_parameters(), image_hash=file_hash(image_path))
+    if args.stream:
+        # The strokes are not known yet; every batch is checked as it arrives
+        parameters.update(mode='stream', quantizer=QUANTIZER, orientations=list(STROKE_ORIENTATIONS))
+        plan_id = plan_hash(parameters)
+    else:
+        plan_id = plan_hash(parameters, batches[0]['strokes'])
 
     # Create connection to the device and get the router
     with utilities.DeviceConnection.createTcpConnection(args) as router:
 
         # Create required services
-        gripper = GripperCommandExample(router)
         base = BaseClient(router)
         base_cyclic = BaseCyclicClient(router)
+        gripper = GripperCommandExample(router, base_cyclic=base_cyclic)
 
         success = True
-        gripper_pos = 0.89 # grip the paintbrush
-        gripper.ExampleSendGripperCommands(base, gripper_pos)
-
-        # HOME
-        success &= example_move_to_home_position(base)
-
-        for stroke in brushstrokes:
-            start_pos = stroke[0]
-            end_pos = stroke[1]
-            color = stroke[2]
-
-            # GO TO COLOR
-            if color == colors[0]:
-                color_pos = COLOR1_POS
-            elif color == colors[1]:
-                color_pos = COLOR2_POS
-                print('white, skip.')
-                continue
-            elif color == colors[2]:
-                color_pos = COLOR3_POS
-            elif color == colors[3]:
-                color_pos = COLOR4_POS
-            else:
-                print("ERROR: color not found")
-                return 1
-
-            # GO TO COLOR
-            lifted_color_pos = (color_pos[0], color_pos[1], color_pos[2] + .05, color_pos[3], color_pos[4], color_pos[5])
-            success &= cartesian_action(base, base_cyclic, lifted_color_pos)
-
-            # DIP IN COLOR
-            success &= cartesian_action(base, base_cyclic, color_pos)
-
-            # LIFT UP
-            success &= cartesian_action(base, base_cyclic, lifted_color_pos)
-            
-            # START OF STROKE
-            lifted_start_pos = (start_pos[0], start_pos[1], start_pos[2] + .05, start_pos[3], start_pos[4], start_pos[5])
-            success &= cartesian_action(base, base_cyclic, lifted_start_pos)
-            success &= cartesian_action(base, base_cyclic, start_pos)
-
-            # PAINT
-            lifted_end_pos = (end_pos[0], end_pos[1], end_pos[2] + .05, end_pos[3], end_pos[4], end_pos[5])
-            success &= cartesian_action(base, base_cyclic, end_pos)
-
-            # LIFT UP
-            success &= cartesian_action(base, base_cyclic, lifted_end_pos)
-
-            print(f'\nstart, end, color_pos: \n{start_pos}, \n{end_pos}, \n{color_pos}, \n{lifted_color_pos}, \n{lifted_start_pos}, \n{end_pos}')
-
+        # The feedback cache runs only while the gripper and the home check read it
+        with feedback_cache(base_cyclic):
+            gripper_pos = 0.89 # grip the paintbrush
+            gripper.ExampleSendGripperCommands(base, gripper_pos)
+
+            # HOME
+            success &= example_move_to_home_position(base, base_cyclic)
+
+        # Paint one blended trajectory per dip instead of one action per move
+        limits = load_limits()
+        motion_log = MotionLog(args.motion_log) if args.motion_log else contextlib.nullcontext()
+        # Start poses of the logged trajectories are read from the feedback cache
+        feedback = feedback_cache(base_cyclic) if args.motion_log else contextlib.nullcontext()
+        with ProgressJournal(args.journal, plan_id, resume=args.resume) as journal, motion_log, feedback:
+            redip = journal.completed >= 0 # the paint on the brush has dried
+            offset = 0 # plan index of the first stroke of the batch
+            for batch in batches:
+                strokes = batch['strokes']
+                journal.start_batch(offset, strokes)
+                skip = min(len(strokes), max(0, journal.completed + 1 - offset))
+                dips = np.array(batch['dips'], dtype=bool)
+                # Re-dip before the first stroke actually painted, not a skipped color
+                painted = np.nonzero([color_positions[color] is not None for color in strokes[skip:, STROKE_COLOR]])[0]
+                if redip and len(painted) > 0:
+                    dips[skip + painted[0]] = True
+                    redip = False
+                paint_left = paint_remaining(strokes, dips)
+
+                runs, last_strokes = compile_stroke_runs(batch['physical_coords'][skip:], strokes[skip:, STROKE_COLOR], dips[skip:], color_positions)
+                _, batch_time = estimate_motion_time([('waypoints', run) for run in runs], limits=limits)
+                print(f"Painting {len(runs)} trajectories, estimated {batch_time:.0f} s")
+                for run, last in zip(runs, last_strokes):
+                    start_pose = feedback.tool_pose(fresh=True) if args.motion_log else None
+                    started = time.time()
+                    if not execute_waypoint_trajectory(base, run):
+                        print(f"Painting stopped, continue with --resume --journal {args.journal}")
+                        return 1
+                    if args.motion_log:
+                        motion_log.record('waypoints', run, start_pose, time.time() - started)
+                    i = skip + last
+                    journal.record(offset + i, int(strokes[i, STROKE_COLOR]), paint_left[i])
+                offset += len(strokes)
+
+        stats = motion_executor(base).stats
+        print("{} moves executed, {} skipped".format(stats['executed'], stats['skipped']))
         return 0 if success else 1
 
 if __name__ == "__main__":
@@ -1,9 +1,17 @@
+import os
+import hashlib
+import json
+import time
+import queue
+import threading
 import cv2
 import numpy as np
-from sklearn.cluster import KMeans
-from PIL import Image
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from scipy.spatial import cKDTree
 import matplotlib.pyplot as plt
 
+from kinematics import rotation_matrices, rotation_thetas
+
 # CONSTANTS
 NUM_COLORS = 4
 STROKE_SIZE = 0.01 # m
@@ -12,6 +20,49 @@ CANVAS_DIM_X = 0.254 # in
 CANVAS_DIM_Y = 0.1905 # in
 
 STROKE_SIZE_PIXELS = int(STROKE_SIZE * RESOLUTION) # old
+PREVIEW_SCALE = 25 # upscaling of the displayed preview
+
+# Color quantization
+QUANTIZER = 'kmeans' # key of QUANTIZERS, see quantizer_benchmark.py
+QUANTIZER_SAMPLE_SIZE = 10000 # pixels used to fit the 'subsample' quantizer
+QUANTIZATION_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'kinova_painting', 'quantization')
+QUANTIZATION_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# Stroke merging
+# Canvas pixels are STROKE_SIZE apart, so runs of neighbouring columns are only
+# merged into one stroke when the brush is at least 2 * STROKE_SIZE wide
+# (BRUSH_WIDTH_PIXELS >= 2). Measure the brush and set its width here; at the
+# default, equal to STROKE_SIZE, merge_strokes only joins gaps within a column.
+BRUSH_WIDTH = 0.01 # m, footprint of the brush across a stroke
+BRUSH_WIDTH_PIXELS = max(1, int(round(BRUSH_WIDTH * RESOLUTION)))
+MAX_STROKE_GAP = 1 # pixels bridged between runs of one column
+
+# Stroke patterns tried on every color region, see extract_strokes
+STROKE_ORIENTATIONS = ('vertical', 'horizontal', 'diagonal', 'anti_diagonal', 'contour')
+
+# Rough arm timing used to compare stroke plans
+TRAVEL_SPEED = 0.1 # m/s, lifted moves between strokes
+PAINT_SPEED = 0.05 # m/s, brush on paper
+MOVE_OVERHEAD = 0.5 # s per cartesian action (notification round trip + settling)
+MOVES_PER_STROKE = 4 # cartesian actions per stroke in painting.py (lifted start, start, end, lifted end)
+MOVES_PER_DIP = 3 # cartesian actions per paint dip (lifted pot, pot, lifted pot)
+
+# Streaming execution
+STREAM_BATCH_STROKES = 200 # largest number of strokes handed to the executor at once
+STREAM_QUEUE_SIZE = 2 # planned batches waiting for the executor
+
+# Saved plans
+PLAN_FORMAT_VERSION = 1
+
+# Plan animations
+ANIMATION_FPS = 10
+ANIMATION_SPEEDUP = 60 # seconds of estimated execution per second of animation
+
+# Paint load
+PAINT_PER_DIP = 0.15 # m of stroke the brush can paint after one dip
+
+# Progress journal
+JOURNAL_SYNC_EVERY = 5 # journal records written between two fsyncs
 
 def preprocessing(image_path):
     original_image = cv2.imread(image_path)
@@ -35,76 +86,835 @@ def preprocessing(image_path):
 
     return resized_image
 
-def apply_kmeans(image, num_clusters=NUM_COLORS):
-
-    # Reshape image for KMeans clustering
-    rows, cols, channels = image.shape
+def show_color_swatches(cluster_centers):
+    for i, color in enumerate(cluster_centers):
+        color_swatch = np.zeros((100, 100, 3), dtype=np.uint8)
+        color_swatch[:, :] = color*255
+        cv2.imshow(f'Color {i + 1}', color_swatch)
 
-    pixels = image.reshape((-1, channels)) #each pixel's RGB values are concatenated into a single vector, flatten image
+def nearest_center(pixels, centers):
+    # (N, K) squared distances; K is a handful of paint colors so this stays small per pixel
+    distances = (pixels ** 2).sum(axis=1)[:, None] - 2 * pixels @ centers.T + (centers ** 2).sum(axis=1)[None, :]
+    return np.argmin(distances, axis=1)
 
-    # Apply KMeans clustering
-    kmeans = KMeans(n_clusters=num_clusters, random_state=42)
+def quantize_kmeans(pixels, num_colors):
+    kmeans = KMeans(n_clusters=num_colors, random_state=42)
     kmeans.fit(pixels)
+    return kmeans.labels_, kmeans.cluster_centers_
+
+def quantize_subsample(pixels, num_colors, sample_size=QUANTIZER_SAMPLE_SIZE):
+    # Fit on a random sample, then label every pixel against the fitted palette
+    rng = np.random.default_rng(42)
+    sample = pixels if len(pixels) <= sample_size else pixels[rng.choice(len(pixels), sample_size, replace=False)]
+    kmeans = KMeans(n_clusters=num_colors, random_state=42)
+    kmeans.fit(sample)
+    return nearest_center(pixels, kmeans.cluster_centers_), kmeans.cluster_centers_
+
+def quantize_minibatch(pixels, num_colors):
+    kmeans = MiniBatchKMeans(n_clusters=num_colors, random_state=42, batch_size=4096, n_init=3)
+    labels = kmeans.fit_predict(pixels)
+    return labels, kmeans.cluster_centers_
+
+def quantize_median_cut(pixels, num_colors):
+    # Repeatedly split the box with the widest channel range at its median
+    boxes = [pixels]
+    while len(boxes) < num_colors:
+        ranges = [np.ptp(box, axis=0).max() if len(box) > 1 else -1.0 for box in boxes]
+        widest = int(np.argmax(ranges))
+        if ranges[widest] <= 0:
+            break
+        box = boxes.pop(widest)
+        channel = np.argmax(np.ptp(box, axis=0))
+        order = np.argsort(box[:, channel], kind='stable')
+        half = len(box) // 2
+        boxes += [box[order[:half]], box[order[half:]]]
+
+    centers = np.array([box.mean(axis=0) for box in boxes])
+    return nearest_center(pixels, centers), centers
+
+def quantize_octree(pixels, num_colors, max_depth=5):
+    # Each pixel sits in one octree node per depth; node codes interleave the
+    # top bits of the three channels. Leaves are merged into their parent, the
+    # least populated parents of the deepest level first, until few enough remain.
+    values = np.clip(pixels * 255, 0, 255).astype(np.int64)
+    codes = np.zeros(len(values), dtype=np.int64)
+    for bit in range(7, 7 - max_depth, -1):
+        codes = (codes << 3) | (((values >> bit) & 1) * np.array([4, 2, 1])).sum(axis=1)
+
+    leaf_codes, leaf_of_pixel, counts = np.unique(codes, return_inverse=True, return_counts=True)
+    sums = np.zeros((len(leaf_codes), pixels.shape[1]))
+    np.add.at(sums, leaf_of_pixel.ravel(), pixels)
+    depths = np.full(len(leaf_codes), max_depth)
+
+    while len(leaf_codes) > num_colors and depths.max() > 1:
+        deepest = depths.max()
+        at_depth = depths == deepest
+        parents, parent_of_leaf, children = np.unique(leaf_codes[at_depth] >> 3, return_inverse=True, return_counts=True)
+        parent_counts = np.bincount(parent_of_leaf.ravel(), weights=counts[at_depth])
+
+        # Merge the fewest parents that bring the leaf count down to num_colors
+        order = np.argsort(parent_counts, kind='stable')
+        saved = np.cumsum(children[order] - 1)
+        enough = np.nonzero(len(leaf_codes) - saved <= num_colors)[0]
+        merged = order if len(enough) == 0 else order[:enough[0] + 1]
+        merge = np.zeros(len(parents), dtype=bool)
+        merge[merged] = True
+
+        collapse = np.zeros(len(leaf_codes), dtype=bool)
+        collapse[at_depth] = merge[parent_of_leaf.ravel()]
+        new_codes = parents[merge]
+        new_counts = np.bincount(parent_of_leaf.ravel(), weights=counts[at_depth], minlength=len(parents))[merge]
+        new_sums = np.stack([np.bincount(parent_of_leaf.ravel(), weights=sums[at_depth, c], minlength=len(parents))[merge]
+                             for c in range(sums.shape[1])], axis=1)
+
+        leaf_codes = np.concatenate((leaf_codes[~collapse], new_codes))
+        counts = np.concatenate((counts[~collapse], new_counts))
+        sums = np.concatenate((sums[~collapse], new_sums))
+        depths = np.concatenate((depths[~collapse], np.full(len(new_codes), deepest - 1)))
+
+    # The eight top-level octants cannot be merged without losing every color,
+    # so keep the most populated ones instead
+    keep = np.argsort(counts, kind='stable')[::-1][:num_colors]
+    centers = sums[keep] / counts[keep, None]
+    return nearest_center(pixels, centers), centers
+
+# Color quantizer backends, all called as quantizer(pixels, num_colors) -> (labels, centers)
+QUANTIZERS = {
+    'kmeans': quantize_kmeans,
+    'subsample': quantize_subsample,
+    'minibatch': quantize_minibatch,
+    'median_cut': quantize_median_cut,
+    'octree': quantize_octree,
+}
 
-    cluster_labels = kmeans.labels_ #index of cluster each pixel belongs to
-    cluster_centers = kmeans.cluster_centers_
+def palette_error(pixels, labels, centers):
+    """Return the RMS distance (0-255 scale) between pixels and their palette color"""
+    return float(np.sqrt(((pixels - centers[labels]) ** 2).sum(axis=1).mean()) * 255)
 
-    # Convert the colors to uint8 format (required for displaying with OpenCV)
-    # cluster_centers = cluster_centers.astype(np.uint8) #coordinates of cluster centers
+def quantize_colors(image, num_clusters=NUM_COLORS, method=QUANTIZER, show=False):
+    """Reduce an image to num_clusters colors with one of the QUANTIZERS backends
+
+    Arguments:
+    image -- (rows, cols, channels) float image in [0, 1]
+    num_clusters -- number of colors
+    method -- key of QUANTIZERS
+    show -- display a swatch window per color
+
+    Returns per-pixel labels (flattened) and the (num_colors, channels) centers.
+    Median cut and octree may return fewer colors on images that have fewer.
+    """
+    if method not in QUANTIZERS:
+        raise ValueError(f'unknown quantizer {method!r}, expected one of {sorted(QUANTIZERS)}')
+
+    # Reshape image for clustering
+    rows, cols, channels = image.shape
+    pixels = image.reshape((-1, channels)) #each pixel's RGB values are concatenated into a single vector, flatten image
+
+    cluster_labels, cluster_centers = QUANTIZERS[method](pixels, num_clusters)
 
     # Display the representative colors
-    # print("displaying")
     for i, color in enumerate(cluster_centers):
-        color_swatch = np.zeros((100, 100, 3), dtype=np.uint8)
-        color_swatch[:, :] = color*255
         print(f'Color {i + 1}: {color*255}')
-        cv2.imshow(f'Color {i + 1}', color_swatch)
+    if show:
+        show_color_swatches(cluster_centers)
 
     return cluster_labels, cluster_centers
 
+def apply_kmeans(image, num_clusters=NUM_COLORS, show=False):
+    return quantize_colors(image, num_clusters, 'kmeans', show)
+
+
+def quantization_cache_key(image, num_clusters=NUM_COLORS, method=QUANTIZER):
+    """Return a content hash identifying a quantization result
+
+    The resized image is hashed, so the key covers both the source image and
+    the resize settings (RESOLUTION, CANVAS_DIM_X/Y) that produced it, along
+    with the number of colors and the quantizer backend.
+    """
+    image = np.ascontiguousarray(image)
+    digest = hashlib.sha256()
+    digest.update(f'{method}-v1|{image.shape}|{image.dtype.str}|{num_clusters}|'.encode())
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+def _evict_quantization_cache(cache_dir, max_bytes, keep):
+    # Least recently used entries go first; hits refresh the files' mtime
+    entries = {}
+    for name in os.listdir(cache_dir):
+        if not name.endswith('.npy'):
+            continue
+        path = os.path.join(cache_dir, name)
+        key = name.split('_')[0]
+        size, last_used = entries.get(key, (0, 0.0))
+        stat = os.stat(path)
+        entries[key] = (size + stat.st_size, max(last_used, stat.st_mtime))
+
+    total = sum(size for size, _ in entries.values())
+    for key, (size, _) in sorted(entries.items(), key=lambda item: item[1][1]):
+        if total <= max_bytes:
+            break
+        if key == keep:
+            continue
+        for suffix in ('_labels.npy', '_centers.npy'):
+            try:
+                os.remove(os.path.join(cache_dir, key + suffix))
+            except FileNotFoundError:
+                pass
+        total -= size
+
+def cached_quantize(image, num_clusters=NUM_COLORS, method=QUANTIZER, cache_dir=QUANTIZATION_CACHE_DIR, max_bytes=QUANTIZATION_CACHE_MAX_BYTES, show=False):
+    """quantize_colors backed by a content-addressed cache on disk
+
+    Arguments:
+    image -- resized image from preprocessing
+    num_clusters -- number of colors
+    method -- key of QUANTIZERS
+    cache_dir -- directory holding the cached .npy files
+    max_bytes -- disk budget of the cache, enforced with LRU eviction
+
+    Labels are returned as a read-only memory map on cache hits. If the cache
+    cannot be written, the result is returned uncached.
+    """
+    key = quantization_cache_key(image, num_clusters, method)
+    labels_path = os.path.join(cache_dir, key + '_labels.npy')
+    centers_path = os.path.join(cache_dir, key + '_centers.npy')
+
+    try:
+        cluster_labels = np.load(labels_path, mmap_mode='r')
+        cluster_centers = np.load(centers_path)
+    except (FileNotFoundError, ValueError):
+        pass
+    else:
+        print(f'quantization cache hit: {key[:12]}')
+        os.utime(labels_path)
+        os.utime(centers_path)
+        if show:
+            show_color_swatches(cluster_centers)
+        return cluster_labels, cluster_centers
+
+    cluster_labels, cluster_centers = quantize_colors(image, num_clusters, method, show)
+
+    # Write under a temporary name first so an interrupted run never leaves half a file
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        for path, array in ((centers_path, cluster_centers), (labels_path, cluster_labels)):
+            tmp_path = path + f'.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                np.save(f, array)
+            os.replace(tmp_path, path)
+        _evict_quantization_cache(cache_dir, max_bytes, keep=key)
+    except OSError as e:
+        # A read-only or full disk only costs the next run a quantization
+        print(f'quantization cache not written: {e}')
+    return cluster_labels, cluster_centers
+
+
+# Columns of the (N, 6) stroke array. A stroke is painted in a straight line
+# from (x, y_start) to (x_end, y_end); the first five columns describe vertical
+# strokes on their own, where x_end == x.
+STROKE_X = 0
+STROKE_Y_START = 1
+STROKE_Y_END = 2
+STROKE_COLOR = 3
+STROKE_LENGTH = 4
+STROKE_X_END = 5
+
+def find_vertical_runs(label_image):
+    """Return every vertical run of identical labels as an (N, 6) int array
+
+    Arguments:
+    label_image -- (rows, cols) array holding the cluster id of every pixel
+
+    Each row of the result is (x, y_start, y_end, color_id, length, x_end),
+    where y_end is inclusive, length is the number of pixels in the run and
+    x_end == x. Runs are ordered by color, then column, then row.
+    """
+    label_image = np.asarray(label_image)
+    rows, cols = label_image.shape
+
+    # Pad with a sentinel above and below so every run has a start and an end edge
+    padded = np.full((cols, rows + 2), -1, dtype=np.int64)
+    padded[:, 1:-1] = label_image.T
+    edges = padded[:, 1:] != padded[:, :-1] # (cols, rows + 1), column-major
+
+    # Starts are edges before a pixel, ends are edges after one; both come out
+    # sorted by column then row so they pair up one to one
+    start_x, start_y = np.nonzero(edges[:, :-1])
+    _, end_y = np.nonzero(edges[:, 1:])
+
+    strokes = np.empty((len(start_x), 6), dtype=np.int64)
+    strokes[:, STROKE_X] = start_x
+    strokes[:, STROKE_Y_START] = start_y
+    strokes[:, STROKE_Y_END] = end_y
+    strokes[:, STROKE_COLOR] = label_image[start_y, start_x]
+    strokes[:, STROKE_LENGTH] = end_y - start_y + 1
+    strokes[:, STROKE_X_END] = start_x
+
+    order = np.lexsort((strokes[:, STROKE_Y_START], strokes[:, STROKE_X], strokes[:, STROKE_COLOR]))
+    return strokes[order]
+
+def palette_colors(cluster_centers, num_colors=NUM_COLORS):
+    """Return the palette as 0-255 color tuples"""
+    palette = (np.asarray(cluster_centers[:num_colors]) * 255).astype(np.int64)
+    return [tuple(int(c) for c in color) for color in palette]
+
+def palette_image(label_image, cluster_centers, num_colors=NUM_COLORS, dtype=np.float32):
+    """Return the quantized image (0-255) of a label image and its palette_colors"""
+    colors = palette_colors(cluster_centers, num_colors)
+    output_image = np.asarray(colors, dtype=np.int64)[np.asarray(label_image)].astype(dtype)
+    return output_image, colors
 
 def draw_straight_strokes(image, cluster_labels, cluster_centers, num_colors=NUM_COLORS, stroke_size=STROKE_SIZE):
     # Draw vertical lines in different colors
-
-    # 1) Assign every STROKE_SIZE x STROKE_SIZE block a color
-    output_image = np.zeros_like(image)
     rows, cols, channels = image.shape
-    strokes = []
-    colors = []
+    label_image = np.asarray(cluster_labels).reshape(rows, cols)
 
-    for cluster_id in range(num_colors): #for each color
-        cluster_indices = np.where(cluster_labels == cluster_id)[0]
-        cluster_color = cluster_centers[cluster_id] * 255
-        cluster_color = (int(cluster_color[0]), int(cluster_color[1]), int(cluster_color[2]))
+    strokes = find_vertical_runs(label_image)
 
-        points_of_color = []
-        for index in cluster_indices: #for all points in color
-            y, x = np.unravel_index(index, (rows, cols))
-            point = (x,y)
-            points_of_color.append(point)
-        sorted_points = sorted(points_of_color, key=lambda k: [k[0], k[1]])
-
-        cols_in_color = set([point[0] for point in sorted_points])
-        for c in cols_in_color:
-            relevant_points = [point for point in sorted_points if point[0]==c]
-            start = relevant_points[0]
-            for i in range(1, len(relevant_points)):
-                if relevant_points[i][1] != relevant_points[i - 1][1] + 1: #if not consecutive
-                    end = relevant_points[i - 1]
-                    strokes.append((start, end, cluster_color))
-                    cv2.line(output_image, start, end, cluster_color, 1)
-
-                    start = relevant_points[i]
-
-            # Add the last range
-            strokes.append((start, relevant_points[-1], cluster_color))
-            if cluster_color not in colors:
-                colors.append(cluster_color)
-            cv2.line(output_image, start, relevant_points[-1], cluster_color, 1)
+    # Every pixel belongs to exactly one run, so the preview is the palette lookup
+    output_image, colors = palette_image(label_image, cluster_centers, num_colors, image.dtype)
 
     return output_image, strokes, colors
 
 
+def _join_gaps(strokes, max_gap):
+    # Join runs of the same color and column separated by at most max_gap pixels
+    top = np.minimum(strokes[:, STROKE_Y_START], strokes[:, STROKE_Y_END])
+    bottom = np.maximum(strokes[:, STROKE_Y_START], strokes[:, STROKE_Y_END])
+    order = np.lexsort((top, strokes[:, STROKE_X], strokes[:, STROKE_COLOR]))
+    strokes, top, bottom = strokes[order], top[order], bottom[order]
+
+    same_line = (strokes[1:, STROKE_COLOR] == strokes[:-1, STROKE_COLOR]) \
+        & (strokes[1:, STROKE_X] == strokes[:-1, STROKE_X])
+    joined = same_line & (top[1:] - bottom[:-1] - 1 <= max_gap)
+    first = np.concatenate(([True], ~joined))
+    group = np.cumsum(first) - 1
+
+    merged = np.empty((group[-1] + 1, 6), dtype=strokes.dtype)
+    merged[:, STROKE_X] = strokes[first, STROKE_X]
+    merged[:, STROKE_X_END] = strokes[first, STROKE_X]
+    merged[:, STROKE_COLOR] = strokes[first, STROKE_COLOR]
+    merged[:, STROKE_Y_START] = np.minimum.reduceat(top, np.nonzero(first)[0])
+    merged[:, STROKE_Y_END] = np.maximum.reduceat(bottom, np.nonzero(first)[0])
+    merged[:, STROKE_LENGTH] = merged[:, STROKE_Y_END] - merged[:, STROKE_Y_START] + 1
+    return merged
+
+def _coalesce_columns(strokes, brush_width):
+    # Sweep columns left to right; a run joins an open group of its color when
+    # the group still fits under the brush and their rows overlap
+    merged = []
+    active = {}
+    for x, top, bottom, color_id, _, _ in strokes[np.lexsort((strokes[:, STROKE_Y_START], strokes[:, STROKE_X], strokes[:, STROKE_COLOR]))]:
+        groups = [g for g in active.get(color_id, []) if x - g[0] < brush_width]
+        for g in groups:
+            if top <= g[3] and bottom >= g[2]:
+                g[1], g[2], g[3] = x, min(g[2], top), max(g[3], bottom)
+                break
+        else:
+            g = [x, x, top, bottom] # first column, last column, top, bottom
+            groups.append(g)
+            merged.append((g, color_id))
+        active[color_id] = groups
+
+    result = np.empty((len(merged), 6), dtype=np.int64)
+    for i, ((x_first, x_last, top, bottom), color_id) in enumerate(merged):
+        x = (x_first + x_last) // 2
+        result[i] = (x, top, bottom, color_id, bottom - top + 1, x)
+    return result
+
+def stroke_pixels(strokes):
+    """Return the stroke index, x and y of every pixel along each stroke
+
+    Strokes run vertically, horizontally or at 45 degrees, so each step moves
+    by at most one pixel along both axes.
+    """
+    dx = strokes[:, STROKE_X_END] - strokes[:, STROKE_X]
+    dy = strokes[:, STROKE_Y_END] - strokes[:, STROKE_Y_START]
+    counts = np.maximum(np.abs(dx), np.abs(dy)) + 1
+
+    index = np.repeat(np.arange(len(strokes)), counts)
+    step = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    x = strokes[index, STROKE_X] + np.sign(dx)[index] * step
+    y = strokes[index, STROKE_Y_START] + np.sign(dy)[index] * step
+    return index, x, y
+
+def brush_coverage(strokes, shape, brush_width=BRUSH_WIDTH_PIXELS):
+    """Return a boolean (rows, cols) mask of the pixels touched by the brush"""
+    _, x, y = stroke_pixels(strokes)
+    covered = np.zeros(shape, dtype=np.uint8)
+    covered[y, x] = 1
+    if brush_width > 1:
+        covered = cv2.dilate(covered, cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (brush_width, brush_width)))
+    return covered.astype(bool)
+
+def coverage_error(strokes, label_image, brush_width=BRUSH_WIDTH_PIXELS):
+    """Return how badly a stroke set reproduces the label image
+
+    Arguments:
+    strokes -- (N, 6) stroke array
+    label_image -- (rows, cols) target cluster id per pixel
+    brush_width -- diameter of the round brush footprint, in pixels
+
+    Returns (missed, overpainted): the fraction of pixels not covered by their
+    own color, and the fraction covered by at least one other color.
+    """
+    label_image = np.asarray(label_image)
+
+    missed = np.zeros_like(label_image, dtype=bool)
+    overpainted = np.zeros_like(label_image, dtype=bool)
+    for color_id in np.unique(label_image):
+        covered = brush_coverage(strokes[strokes[:, STROKE_COLOR] == color_id], label_image.shape, brush_width)
+        target = label_image == color_id
+        missed |= target & ~covered
+        overpainted |= ~target & covered
+
+    return missed.mean(), overpainted.mean()
+
+def merge_strokes(strokes, label_image, brush_width=BRUSH_WIDTH_PIXELS, max_gap=MAX_STROKE_GAP, verbose=True):
+    """Drop vertical strokes the brush covers anyway
+
+    Arguments:
+    strokes -- (N, 6) array of vertical strokes from find_vertical_runs
+    label_image -- (rows, cols) target cluster id per pixel
+    brush_width -- brush footprint across the stroke, in pixels
+    max_gap -- largest gap (pixels) bridged between runs of one column
+    verbose -- print the stroke count and coverage error before and after
+
+    Runs of a column separated by small gaps are joined first, then runs of
+    neighbouring columns that overlap and fit under one brush width are
+    painted as a single stroke along the middle column. The second step needs
+    brush_width >= 2; with a one pixel brush every column keeps its strokes.
+    """
+    merged = _coalesce_columns(_join_gaps(np.asarray(strokes), max_gap), brush_width)
+    merged = merged[np.lexsort((merged[:, STROKE_Y_START], merged[:, STROKE_X], merged[:, STROKE_COLOR]))]
+
+    if verbose:
+        before = coverage_error(strokes, label_image, brush_width)
+        after = coverage_error(merged, label_image, brush_width)
+        print(f'strokes: {len(strokes)} -> {len(merged)}')
+        print(f'missed pixels: {before[0]:.2%} -> {after[0]:.2%}, overpainted pixels: {before[1]:.2%} -> {after[1]:.2%}')
+
+    return merged
+
+# Unit pixel step along each straight stroke orientation
+STROKE_DIRECTIONS = {
+    'vertical': (0, 1),
+    'horizontal': (1, 0),
+    'diagonal': (1, 1),
+    'anti_diagonal': (1, -1),
+}
+
+def find_runs(label_image, direction='vertical'):
+    """Return every run of identical labels along one of STROKE_DIRECTIONS
+
+    Same layout and ordering (color first) as find_vertical_runs.
+    """
+    if direction == 'vertical':
+        return find_vertical_runs(label_image)
+
+    label_image = np.asarray(label_image)
+    dx, dy = STROKE_DIRECTIONS[direction]
+    y, x = np.indices(label_image.shape).reshape(2, -1)
+    color = label_image.ravel()
+
+    # Pixels of one line share the coordinate across the direction; none of the
+    # non-vertical directions is vertical, so x counts steps along the line
+    line = x * dy - y * dx
+    order = np.lexsort((x, line, color))
+    x, y, line, color = x[order], y[order], line[order], color[order]
+
+    new_run = np.ones(len(x), dtype=bool)
+    new_run[1:] = (color[1:] != color[:-1]) | (line[1:] != line[:-1]) | (x[1:] != x[:-1] + 1)
+    first = np.nonzero(new_run)[0]
+    last = np.append(first[1:], len(x)) - 1
+
+    strokes = np.empty((len(first), 6), dtype=np.int64)
+    strokes[:, STROKE_X] = x[first]
+    strokes[:, STROKE_Y_START] = y[first]
+    strokes[:, STROKE_X_END] = x[last]
+    strokes[:, STROKE_Y_END] = y[last]
+    strokes[:, STROKE_COLOR] = color[first]
+    strokes[:, STROKE_LENGTH] = last - first + 1
+    return strokes
+
+def find_contour_strokes(label_image, brush_width=BRUSH_WIDTH_PIXELS, color_ids=None):
+    """Fill every color region with concentric strokes following its boundary
+
+    Arguments:
+    label_image -- (rows, cols) cluster id per pixel
+    brush_width -- brush footprint, in pixels; sets the spacing of the rings
+    color_ids -- only fill these colors (None = all)
+
+    Each ring is a closed polyline from cv2.findContours, painted as a chain
+    of straight strokes that share their end points. Returns the (N, 6) stroke
+    array and a boolean array marking the first stroke of every ring.
+    """
+    label_image = np.asarray(label_image)
+    strokes = []
+    chain_starts = []
+    for color_id in np.unique(label_image) if color_ids is None else color_ids:
+        remaining = (label_image == color_id).astype(np.uint8)
+        while remaining.any():
+            contours, _ = cv2.findContours(remaining, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
+            ring = []
+            for contour in contours:
+                points = contour[:, 0, :]
+                if len(points) > 2:
+                    points = np.vstack((points, points[:1]))
+                starts, ends = (points, points) if len(points) == 1 else (points[:-1], points[1:])
+
+                segments = np.empty((len(starts), 6), dtype=np.int64)
+                segments[:, [STROKE_X, STROKE_Y_START]] = starts
+                segments[:, [STROKE_X_END, STROKE_Y_END]] = ends
+                segments[:, STROKE_COLOR] = color_id
+                segments[:, STROKE_LENGTH] = np.abs(ends - starts).max(axis=1) + 1
+                ring.append(segments)
+                chain_starts.append(np.arange(len(segments)) == 0)
+
+            # Peel off exactly what this ring paints so the next one starts inside it
+            ring = np.vstack(ring)
+            remaining[brush_coverage(ring, remaining.shape, brush_width)] = 0
+            strokes.append(ring)
+
+    if not strokes:
+        return np.empty((0, 6), dtype=np.int64), np.empty(0, dtype=bool)
+    return np.vstack(strokes), np.concatenate(chain_starts)
+
+def label_regions(label_image):
+    """Return a (rows, cols) id of the 8-connected single-color region of every pixel"""
+    label_image = np.asarray(label_image)
+    regions = np.zeros(label_image.shape, dtype=np.int64)
+    offset = 0
+    for color_id in np.unique(label_image):
+        mask = label_image == color_id
+        count, components = cv2.connectedComponents(mask.astype(np.uint8), connectivity=8)
+        regions[mask] = components[mask] - 1 + offset
+        offset += count - 1
+    return regions
+
+def stroke_candidates(label_image, orientations=STROKE_ORIENTATIONS, brush_width=BRUSH_WIDTH_PIXELS):
+    """Return the region labelling and candidate stroke patterns of extract_strokes
+
+    Computing them once lets several extract_strokes calls on single colors
+    share them. Returns (regions, [(name, strokes, chain_starts), ...]).
+    """
+    label_image = np.asarray(label_image)
+    patterns = []
+    for name in orientations:
+        if name == 'contour':
+            strokes, chain_starts = find_contour_strokes(label_image, brush_width)
+        else:
+            strokes = find_runs(label_image, name)
+            chain_starts = np.ones(len(strokes), dtype=bool)
+        patterns.append((name, strokes, chain_starts))
+    return label_regions(label_image), patterns
+
+def extract_strokes(label_image, orientations=STROKE_ORIENTATIONS, criterion='strokes', brush_width=BRUSH_WIDTH_PIXELS, merge=True, color_ids=None, verbose=True, candidates=None):
+    """Cover every color region with the cheapest of several stroke patterns
+
+    Arguments:
+    label_image -- (rows, cols) cluster id per pixel
+    orientations -- STROKE_DIRECTIONS keys and/or 'contour' to try
+    criterion -- 'strokes' picks the fewest brush lifts per region, 'length'
+        the least painted path length
+    brush_width -- brush footprint, in pixels
+    merge -- run merge_strokes on the selected vertical strokes
+    color_ids -- only return strokes of these colors (None = all)
+    verbose -- print how many regions each pattern won and the stroke count
+    candidates -- stroke_candidates of label_image, computed here if None
+
+    Each candidate pattern covers the whole image; every stroke belongs to the
+    region of its start pixel, so the costs of the candidates can be compared
+    region by region. A contour ring counts as a single brush lift.
+    """
+    label_image = np.asarray(label_image)
+    regions, patterns = stroke_candidates(label_image, orientations, brush_width) if candidates is None else candidates
+    num_regions = int(regions.max()) + 1
+
+    candidates = []
+    costs = []
+    for name, strokes, chain_starts in patterns:
+        if color_ids is not None:
+            keep = np.isin(strokes[:, STROKE_COLOR], color_ids)
+            strokes, chain_starts = strokes[keep], chain_starts[keep]
+        region = regions[strokes[:, STROKE_Y_START], strokes[:, STROKE_X]]
+        weights = chain_starts if criterion == 'strokes' else strokes[:, STROKE_LENGTH]
+        candidates.append((name, strokes, region))
+        costs.append(np.bincount(region, weights=weights, minlength=num_regions))
+
+    best = np.argmin(np.vstack(costs), axis=0)
+    selected = []
+    for i, (name, strokes, region) in enumerate(candidates):
+        chosen = strokes[best[region] == i]
+        if name == 'vertical' and merge and len(chosen) > 0:
+            chosen = merge_strokes(chosen, label_image, brush_width, verbose=False)
+        selected.append(chosen)
+        if verbose:
+            print(f'{name}: {np.count_nonzero(best == i)} regions, {len(chosen)} strokes')
+
+    strokes = np.vstack(selected)
+    # Keep contour chains in order; only bring each color together
+    strokes = strokes[np.argsort(strokes[:, STROKE_COLOR], kind='stable')]
+
+    if verbose:
+        missed, overpainted = coverage_error(strokes, label_image, brush_width)
+        print(f'strokes: {len(strokes)}, missed pixels: {missed:.2%}, overpainted pixels: {overpainted:.2%}')
+
+    return strokes
+
+def stroke_endpoints(strokes):
+    """Return the (N, 2) pixel start and end points of each stroke
+
+    A stroke is painted from (x, y_start) to (x_end, y_end); the optimizer
+    swaps both ends of the strokes it decided to paint the other way.
+    """
+    starts = strokes[:, [STROKE_X, STROKE_Y_START]].astype(np.float64)
+    ends = strokes[:, [STROKE_X_END, STROKE_Y_END]].astype(np.float64)
+    return starts, ends
+
+def plan_travel_distance(strokes, start_point=(0, 0)):
+    """Return the lifted travel distance of a stroke plan, in pixels
+
+    Arguments:
+    strokes -- (N, 6) stroke array, in execution order
+    start_point -- (x, y) pixel where the brush is before the first stroke
+    """
+    if len(strokes) == 0:
+        return 0.0
+    starts, ends = stroke_endpoints(strokes)
+    previous = np.vstack((np.asarray(start_point, dtype=np.float64), ends[:-1]))
+    return float(np.linalg.norm(starts - previous, axis=1).sum())
+
+def chained_strokes(strokes, dips=None):
+    """Return True for strokes painted without lifting the brush
+
+    A stroke continues the previous one when it has the same color, starts
+    where the previous one ended and is not preceded by a dip.
+    """
+    starts, ends = stroke_endpoints(strokes)
+    chained = np.zeros(len(strokes), dtype=bool)
+    chained[1:] = (strokes[1:, STROKE_COLOR] == strokes[:-1, STROKE_COLOR]) & np.all(starts[1:] == ends[:-1], axis=1)
+    if dips is not None:
+        chained &= ~np.asarray(dips, dtype=bool)
+    return chained
+
+def count_plan_moves(strokes, dips=None):
+    """Return the number of cartesian actions needed to execute a stroke plan
+
+    Arguments:
+    strokes -- (N, 6) stroke array
+    dips -- boolean array from schedule_dips (None = dip before every stroke)
+
+    A chained stroke only moves to its end point.
+    """
+    num_dips = len(strokes) if dips is None else int(np.count_nonzero(dips))
+    num_chained = int(np.count_nonzero(chained_strokes(strokes, dips))) if dips is not None else 0
+    return len(strokes) * MOVES_PER_STROKE - num_chained * (MOVES_PER_STROKE - 1) + num_dips * MOVES_PER_DIP
+
+def estimate_plan_time(strokes, start_point=(0, 0), dips=None):
+    """Return a rough execution time estimate for a stroke plan, in seconds
+
+    Travel and painting are timed at constant speed, and every cartesian action
+    pays a fixed MOVE_OVERHEAD for the notification round trip and settling.
+    """
+    travel = plan_travel_distance(strokes, start_point) * STROKE_SIZE
+    starts, ends = stroke_endpoints(strokes)
+    painted = float(np.linalg.norm(ends - starts, axis=1).sum()) * STROKE_SIZE
+    return travel / TRAVEL_SPEED + painted / PAINT_SPEED + count_plan_moves(strokes, dips) * MOVE_OVERHEAD
+
+def stroke_timestamps(strokes, start_point=(0, 0), dips=None):
+    """Return the estimated time (s) at which each stroke is finished
+
+    Uses the model of estimate_plan_time, so the last timestamp equals it.
+    """
+    if len(strokes) == 0:
+        return np.zeros(0)
+    starts, ends = stroke_endpoints(strokes)
+    previous = np.vstack((np.asarray(start_point, dtype=np.float64), ends[:-1]))
+    travel = np.linalg.norm(starts - previous, axis=1) * STROKE_SIZE
+    painted = np.linalg.norm(ends - starts, axis=1) * STROKE_SIZE
+
+    dipped = np.ones(len(strokes), dtype=bool) if dips is None else np.asarray(dips, dtype=bool)
+    moves = np.full(len(strokes), MOVES_PER_STROKE)
+    if dips is not None:
+        moves[chained_strokes(strokes, dips)] = 1
+    moves += dipped * MOVES_PER_DIP
+    return np.cumsum(travel / TRAVEL_SPEED + painted / PAINT_SPEED + moves * MOVE_OVERHEAD)
+
+def schedule_dips(strokes, paint_per_dip=PAINT_PER_DIP, verbose=True):
+    """Group strokes by color and decide before which ones the brush is dipped
+
+    Arguments:
+    strokes -- (N, 6) stroke array, in execution order
+    paint_per_dip -- stroke length (m) the brush can paint after one dip
+    verbose -- print the number of dips and cartesian actions saved
+
+    Returns the strokes grouped by color (keeping their relative order) and a
+    boolean array that is True where a dip is needed before the stroke. The
+    brush is dipped on every color change and whenever the next stroke would
+    exceed the remaining paint; a stroke longer than the budget gets one dip.
+    """
+    strokes = np.asarray(strokes)
+    _, first_seen, color_rank = np.unique(strokes[:, STROKE_COLOR], return_index=True, return_inverse=True)
+    rank_by_first_seen = np.argsort(np.argsort(first_seen))
+    strokes = strokes[np.argsort(rank_by_first_seen[color_rank], kind='stable')]
+
+    lengths = strokes[:, STROKE_LENGTH] * STROKE_SIZE
+    dips = np.zeros(len(strokes), dtype=bool)
+    paint_left = 0.0
+    previous_color = None
+    for i, (color_id, length) in enumerate(zip(strokes[:, STROKE_COLOR], lengths)):
+        if color_id != previous_color or length > paint_left:
+            dips[i] = True
+            paint_left = paint_per_dip
+            previous_color = color_id
+        paint_left -= length
+
+    if verbose:
+        print(f'dips: {len(strokes)} -> {np.count_nonzero(dips)}')
+        print(f'cartesian actions: {count_plan_moves(strokes)} -> {count_plan_moves(strokes, dips)}')
+
+    return strokes, dips
+
+def paint_remaining(strokes, dips, paint_per_dip=PAINT_PER_DIP):
+    """Paint (m of stroke) left on the brush after each stroke of a dip schedule
+
+    Strokes before the first dip are assumed to start from a full brush.
+    """
+    lengths = np.asarray(strokes)[:, STROKE_LENGTH] * STROKE_SIZE
+    used = np.cumsum(lengths)
+    dips = np.asarray(dips, dtype=bool)
+    dip_index = np.nonzero(dips)[0]
+    before_dip = np.concatenate(([0.0], used[dip_index] - lengths[dip_index]))
+    return np.maximum(paint_per_dip - (used - before_dip[np.cumsum(dips)]), 0.0)
+
+def _nearest_neighbour_tour(starts, ends, start_point):
+    # Greedy tour over both endpoints of every stroke. Returns the visiting order
+    # and whether each visited stroke is painted end -> start.
+    n = len(starts)
+    endpoints = np.vstack((starts, ends)) # endpoint k belongs to stroke k % n
+    visited = np.zeros(n, dtype=bool)
+    order = np.empty(n, dtype=np.int64)
+    flipped = np.zeros(n, dtype=bool)
+
+    candidates = np.arange(2 * n)
+    tree = cKDTree(endpoints)
+    position = np.asarray(start_point, dtype=np.float64)
+    for step in range(n):
+        # Rebuild the tree once most of its points belong to painted strokes
+        if step > 0 and 2 * (n - step) < len(candidates) // 2:
+            candidates = candidates[~visited[candidates % n]]
+            tree = cKDTree(endpoints[candidates])
+
+        k = min(8, len(candidates))
+        while True:
+            _, found = tree.query(position, k=k)
+            found = np.atleast_1d(found)
+            free = found[~visited[candidates[found] % n]]
+            if len(free) > 0 or k == len(candidates):
+                break
+            k = min(2 * k, len(candidates))
+
+        endpoint = candidates[free[0]]
+        stroke = endpoint % n
+        visited[stroke] = True
+        order[step] = stroke
+        flipped[step] = endpoint >= n
+        position = starts[stroke] if flipped[step] else ends[stroke]
+
+    return order, flipped
+
+def _two_opt(starts, ends, start_point, max_passes, window):
+    # 2-opt over oriented strokes. Reversing a segment also flips every stroke in
+    # it, so only the two travel moves at the segment boundaries change length.
+    n = len(starts)
+    starts = starts.copy()
+    ends = ends.copy()
+    order = np.arange(n)
+    flipped = np.zeros(n, dtype=bool)
+    start_point = np.asarray(start_point, dtype=np.float64)
+
+    for _ in range(max_passes):
+        improved = False
+        for i in range(n - 1):
+            last = n if window is None else min(n, i + 1 + window)
+            j = np.arange(i + 1, last)
+            previous = ends[i - 1] if i > 0 else start_point
+
+            # Travel after the segment disappears when it ends the plan
+            has_next = j + 1 < n
+            following = starts[np.minimum(j + 1, n - 1)]
+            old_cost = np.linalg.norm(starts[i] - previous) \
+                + np.where(has_next, np.linalg.norm(following - ends[j], axis=1), 0.0)
+            new_cost = np.linalg.norm(ends[j] - previous, axis=1) \
+                + np.where(has_next, np.linalg.norm(following - starts[i], axis=1), 0.0)
+            delta = new_cost - old_cost
+
+            best = int(np.argmin(delta))
+            if delta[best] < -1e-9:
+                j = j[best]
+                segment = slice(i, j + 1)
+                starts[segment], ends[segment] = ends[segment][::-1].copy(), starts[segment][::-1].copy()
+                order[segment] = order[segment][::-1]
+                flipped[segment] = ~flipped[segment][::-1]
+                improved = True
+        if not improved:
+            break
+
+    return order, flipped
+
+def _orient(strokes, flipped):
+    strokes = strokes.copy()
+    strokes[flipped, STROKE_Y_START], strokes[flipped, STROKE_Y_END] = \
+        strokes[flipped, STROKE_Y_END], strokes[flipped, STROKE_Y_START]
+    strokes[flipped, STROKE_X], strokes[flipped, STROKE_X_END] = \
+        strokes[flipped, STROKE_X_END], strokes[flipped, STROKE_X]
+    return strokes
+
+def optimize_stroke_order(strokes, start_point=(0, 0), max_passes=5, window=100, verbose=True):
+    """Reorder and orient strokes within each color to shorten lifted travel
+
+    Arguments:
+    strokes -- (N, 6) stroke array from draw_straight_strokes
+    start_point -- (x, y) pixel where the brush is before the first stroke
+    max_passes -- maximum number of 2-opt improvement passes per color
+    window -- how far ahead 2-opt looks for a segment end (None = whole tour)
+    verbose -- print travel distance and estimated time before and after
+
+    Colors keep their original order; each color is toured with a KD-tree
+    nearest-neighbour pass and refined with 2-opt. A stroke may be painted in
+    either direction, in which case its y_start and y_end are swapped.
+    """
+    strokes = np.asarray(strokes)
+    optimized = []
+    position = np.asarray(start_point, dtype=np.float64)
+
+    _, first_seen = np.unique(strokes[:, STROKE_COLOR], return_index=True)
+    for color_id in strokes[np.sort(first_seen), STROKE_COLOR]:
+        group = strokes[strokes[:, STROKE_COLOR] == color_id]
+        starts, ends = stroke_endpoints(group)
+
+        order, flipped = _nearest_neighbour_tour(starts, ends, position)
+        group = _orient(group[order], flipped)
+
+        starts, ends = stroke_endpoints(group)
+        order, flipped = _two_opt(starts, ends, position, max_passes, window)
+        group = _orient(group[order], flipped)
+
+        optimized.append(group)
+        position = stroke_endpoints(group[-1:])[1][0]
+
+    optimized = np.vstack(optimized) if optimized else strokes.copy()
+
+    if verbose:
+        before = plan_travel_distance(strokes, start_point) * STROKE_SIZE
+        after = plan_travel_distance(optimized, start_point) * STROKE_SIZE
+        print(f'travel distance: {before:.2f} m -> {after:.2f} m')
+        print(f'estimated time: {estimate_plan_time(strokes, start_point):.0f} s -> {estimate_plan_time(optimized, start_point):.0f} s')
+
+    return optimized
+
+
 def draw_strokes(image, cluster_labels, cluster_centers, num_colors=NUM_COLORS, stroke_size=STROKE_SIZE_PIXELS):
     # Create a new canvas to draw strokes
     output_image = np.zeros_like(image)
@@ -150,47 +960,509 @@ def draw_strokes(image, cluster_labels, cluster_centers, num_colors=NUM_COLORS,
 
     return output_image, start_end_points
 
+def canvas_transform_from_origin(ROBOT_ORIGIN):
+    """Return the axis-aligned canvas transform anchored at a robot pose
+
+    Pixel (x, y) maps to robot (ROBOT_ORIGIN[0] + y * STROKE_SIZE,
+    ROBOT_ORIGIN[1] - x * STROKE_SIZE) at the origin's height and orientation.
+    """
+    origin = np.asarray(ROBOT_ORIGIN, dtype=np.float64)
+    homography = np.array([[0.0, STROKE_SIZE, origin[0]],
+                           [-STROKE_SIZE, 0.0, origin[1]],
+                           [0.0, 0.0, 1.0]])
+    return {
+        'homography': homography,
+        'z_plane': np.array([0.0, 0.0, origin[2]]),
+        'orientation': origin[3:6].copy(),
+    }
+
+def canvas_size():
+    """(rows, cols) of the canvas, as preprocessing resizes images"""
+    return int(RESOLUTION * CANVAS_DIM_X), int(RESOLUTION * CANVAS_DIM_Y)
+
+def canvas_corners(rows=None, cols=None):
+    """Pixel coordinates of the canvas corners, in the order they are touched off
+
+    Defaults to the size preprocessing resizes images to.
+    """
+    rows = canvas_size()[0] if rows is None else rows
+    cols = canvas_size()[1] if cols is None else cols
+    return np.array([(0, 0), (cols - 1, 0), (cols - 1, rows - 1), (0, rows - 1)], dtype=np.float64)
+
+def estimate_canvas_transform(pixel_corners, robot_corners):
+    """Estimate the canvas transform from touched-off corners
+
+    Arguments:
+    pixel_corners -- (K, 2) pixel coordinates of the corners, K >= 3
+    robot_corners -- (K, 6) robot poses measured with the brush on each corner
+
+    Three corners give an affine map, four or more a homography. The paper
+    height is fitted as a plane so a slightly tilted canvas is followed, and
+    the orientation is the mean of the touched-off orientations, averaged as
+    rotations so that angles on either side of +/-180 deg do not cancel out.
+    """
+    pixel_corners = np.asarray(pixel_corners, dtype=np.float64)
+    robot_corners = np.asarray(robot_corners, dtype=np.float64)
+    if len(pixel_corners) < 3 or len(pixel_corners) != len(robot_corners):
+        raise ValueError('need at least three matching pixel and robot corners')
+
+    design = np.column_stack((pixel_corners, np.ones(len(pixel_corners))))
+    if len(pixel_corners) == 3:
+        affine = np.linalg.solve(design, robot_corners[:, :2]).T
+        homography = np.vstack((affine, (0.0, 0.0, 1.0)))
+    else:
+        homography, _ = cv2.findHomography(pixel_corners, robot_corners[:, :2])
+        if homography is None:
+            raise ValueError('canvas corners are degenerate')
+
+    z_plane = np.linalg.lstsq(design, robot_corners[:, 2], rcond=None)[0]
+
+    # Project the mean rotation matrix back onto the rotations
+    u, _, vt = np.linalg.svd(rotation_matrices(robot_corners[:, 3:6]).mean(axis=0))
+    mean_rotation = u @ np.diag((1.0, 1.0, np.linalg.det(u @ vt))) @ vt
+    return {
+        'homography': homography,
+        'z_plane': z_plane,
+        'orientation': rotation_thetas(mean_rotation[None])[0],
+    }
+
 def pixel_to_physical_coords(pixel_coords, ROBOT_ORIGIN):
-    physical_coords = []
-    # [(start_x, start_y, start_z, thetax, thetay, thetaz), (end_x, end_y, end_z, thetax, thetay, thetaz), (r, g, b))]
-    for i in range(len(pixel_coords)):
-        start_x, start_y = pixel_coords[i][0]
-        end_x, end_y = pixel_coords[i][1]
-        cur = []
-        cur.append((start_y * STROKE_SIZE + ROBOT_ORIGIN[0], ROBOT_ORIGIN[1] - (start_x * STROKE_SIZE), ROBOT_ORIGIN[2], ROBOT_ORIGIN[3], ROBOT_ORIGIN[4], ROBOT_ORIGIN[5]))
-        cur.append((end_y * STROKE_SIZE + ROBOT_ORIGIN[0], ROBOT_ORIGIN[1] - (end_x * STROKE_SIZE), ROBOT_ORIGIN[2], ROBOT_ORIGIN[3], ROBOT_ORIGIN[4], ROBOT_ORIGIN[5]))
-        cur.append(pixel_coords[i][2])
-        physical_coords.append(cur)
-    return physical_coords
-
-def painting(image_path, save_path, ROBOT_ORIGIN):
+    """Map strokes to robot poses in one vectorized pass
+
+    Arguments:
+    pixel_coords -- (N, 6) stroke array
+    ROBOT_ORIGIN -- robot pose of pixel (0, 0), or a transform from
+        estimate_canvas_transform / canvas_transform_from_origin
+
+    Returns a contiguous (N, 2, 6) float64 array of start and end poses
+    (x, y, z, theta_x, theta_y, theta_z).
+    """
+    transform = canvas_transform(ROBOT_ORIGIN)
+    strokes = np.asarray(pixel_coords)
+
+    points = np.ones((len(strokes), 2, 3))
+    points[:, 0, 0] = strokes[:, STROKE_X]
+    points[:, 1, 0] = strokes[:, STROKE_X_END]
+    points[:, 0, 1] = strokes[:, STROKE_Y_START]
+    points[:, 1, 1] = strokes[:, STROKE_Y_END]
+
+    projected = points @ transform['homography'].T
+    poses = np.empty((len(strokes), 2, 6))
+    poses[:, :, :2] = projected[:, :, :2] / projected[:, :, 2:]
+    poses[:, :, 2] = points @ transform['z_plane']
+    poses[:, :, 3:] = transform['orientation']
+    return poses
+
+def render_preview(output_image, scale=PREVIEW_SCALE):
+    """Upscale a stroke preview in memory, keeping every pixel a sharp block"""
+    output_image = np.clip(output_image, 0, 255).astype(np.uint8)
+    rows, cols = output_image.shape[:2]
+    return cv2.resize(output_image, (cols * scale, rows * scale), interpolation=cv2.INTER_NEAREST)
+
+def _last_stroke_image(strokes, shape, scale, brush_width, first=0):
+    # 1 + index of the last stroke whose brush footprint covers each upscaled
+    # pixel (0 = bare canvas). Painting order is a max over stroke indices, so
+    # the footprint is applied with one grey dilation of the centerlines.
+    scaled = np.array(strokes, dtype=np.int64)
+    columns = [STROKE_X, STROKE_X_END, STROKE_Y_START, STROKE_Y_END]
+    scaled[:, columns] = scaled[:, columns] * scale + scale // 2
+    index, x, y = stroke_pixels(scaled)
 
+    last = np.zeros((shape[0] * scale, shape[1] * scale), dtype=np.float32)
+    np.maximum.at(last, (y, x), (index + first + 1).astype(np.float32))
+    footprint = max(1, int(round(brush_width * scale)))
+    if footprint > 1:
+        last = cv2.dilate(last, cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (footprint, footprint)))
+    return last
+
+def render_strokes(strokes, colors, shape=None, scale=1, brush_width=BRUSH_WIDTH_PIXELS, background=(255, 255, 255)):
+    """Rasterize a stroke plan as it would be painted, in one pass
+
+    Arguments:
+    strokes -- (N, 6) stroke array, in execution order
+    colors -- palette indexed by stroke color id, as returned by plan_painting
+    shape -- (rows, cols) of the canvas in pixels, canvas_size() by default
+    scale -- upscaling factor of the rendered image
+    brush_width -- diameter of the round brush footprint, in canvas pixels
+    background -- color of the bare canvas
+
+    Later strokes paint over earlier ones. Returns a uint8 image.
+    """
+    strokes = np.asarray(strokes)
+    shape = canvas_size() if shape is None else shape
+    last = _last_stroke_image(strokes, shape, scale, brush_width).astype(np.int64)
+    lut = np.vstack((np.asarray(background), np.asarray(colors)[strokes[:, STROKE_COLOR]])).reshape(-1, 3)
+    return np.clip(lut[last], 0, 255).astype(np.uint8)
+
+def export_plan_animation(path, plan, scale=PREVIEW_SCALE, fps=ANIMATION_FPS, speedup=ANIMATION_SPEEDUP, shape=None):
+    """Write a video of a plan being painted, timed by stroke_timestamps
+
+    Arguments:
+    path -- output video file (.mp4 or .avi)
+    plan -- dict with 'strokes', 'colors' and optionally 'dips'
+    scale -- upscaling factor of the frames
+    fps -- frames per second of the video
+    speedup -- seconds of estimated execution shown per second of video
+
+    Each frame only rasterizes the strokes finished since the previous one.
+    Returns the estimated execution time, in seconds.
+    """
+    strokes = np.asarray(plan['strokes'])
+    shape = canvas_size() if shape is None else shape
+    finished = stroke_timestamps(strokes, dips=plan.get('dips'))
+    total = float(finished[-1]) if len(finished) else 0.0
+    lut = np.vstack(((255, 255, 255), np.asarray(plan['colors'])[strokes[:, STROKE_COLOR]])).reshape(-1, 3).astype(np.uint8)
+
+    fourcc = cv2.VideoWriter_fourcc(*('MJPG' if path.endswith('.avi') else 'mp4v'))
+    writer = cv2.VideoWriter(path, fourcc, fps, (shape[1] * scale, shape[0] * scale))
+    if not writer.isOpened():
+        raise IOError(f'cannot write video {path}')
+
+    last = np.zeros((shape[0] * scale, shape[1] * scale), dtype=np.float32)
+    done = 0
+    num_frames = int(np.ceil(total * fps / speedup)) + 1
+    try:
+        for frame in range(num_frames):
+            count = int(np.searchsorted(finished, frame * speedup / fps, side='right'))
+            if count > done:
+                np.maximum(last, _last_stroke_image(strokes[done:count], shape, scale, BRUSH_WIDTH_PIXELS, first=done), out=last)
+                done = count
+            writer.write(lut[last.astype(np.int64)])
+    finally:
+        writer.release()
+    return total
+
+def file_hash(path):
+    """SHA-256 of a file's bytes, read in chunks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def canvas_transform(ROBOT_ORIGIN):
+    """Return ROBOT_ORIGIN as a canvas transform dict"""
+    return ROBOT_ORIGIN if isinstance(ROBOT_ORIGIN, dict) else canvas_transform_from_origin(ROBOT_ORIGIN)
+
+def plan_painting(image_path, ROBOT_ORIGIN, preview_scale=None, use_cache=False, quantizer=QUANTIZER, orientations=STROKE_ORIENTATIONS, show=False):
+    """Run the whole planning pipeline, without touching disk unless use_cache
+    is set or opening a window unless show is set
+
+    Arguments:
+    image_path -- source image
+    ROBOT_ORIGIN -- robot pose of the canvas origin, or a canvas transform
+    preview_scale -- if set, also render a preview upscaled by this factor
+    use_cache -- reuse quantization results of an already seen image, from QUANTIZATION_CACHE_DIR
+    quantizer -- key of QUANTIZERS used to reduce the image to NUM_COLORS
+    orientations -- stroke patterns extract_strokes may choose from
+    show -- display a swatch window per palette color
+
+    Returns a dict with the pixel 'strokes' array, the (N, 2, 6) robot
+    'physical_coords', the 'colors' palette, the 'dips' flags, the source
+    'image_hash', the 'canvas_transform', the unscaled 'output_image' and the
+    upscaled 'preview' rendered from the strokes (None unless preview_scale is given).
+    """
     resized_image = preprocessing(image_path)
 
-    labels, centers = apply_kmeans(resized_image)
-    output_image, start_end_points, colors = draw_straight_strokes(resized_image, labels, centers)
+    if use_cache:
+        labels, centers = cached_quantize(resized_image, method=quantizer, show=show)
+    else:
+        labels, centers = quantize_colors(resized_image, method=quantizer, show=show)
+    label_image = np.asarray(labels).reshape(resized_image.shape[:2])
+    output_image, colors = palette_image(label_image, centers, dtype=resized_image.dtype)
+    start_end_points = extract_strokes(label_image, orientations)
+    start_end_points = optimize_stroke_order(start_end_points)
+    start_end_points, dips = schedule_dips(start_end_points)
 
     physical_coords = pixel_to_physical_coords(start_end_points, ROBOT_ORIGIN)
 
-    # Display painting
-    # cv2.imshow('Stroke-Based Painting', output_image/255)
-    cv2.imwrite(save_path, output_image)
+    print(f'num strokes: {len(start_end_points)}')
+    return {
+        'strokes': start_end_points,
+        'physical_coords': physical_coords,
+        'colors': colors,
+        'dips': dips,
+        'image_hash': file_hash(image_path),
+        'canvas_transform': canvas_transform(ROBOT_ORIGIN),
+        'output_image': output_image,
+        'preview': render_strokes(start_end_points, colors, label_image.shape, preview_scale) if preview_scale else None,
+    }
 
-    scaled_img = Image.open(save_path)
-    scaled_img = scaled_img.resize((int(RESOLUTION * CANVAS_DIM_Y * 25), int(RESOLUTION * CANVAS_DIM_X * 25)))
-    scaled_img_cv2 = cv2.cvtColor(np.array(scaled_img), cv2.COLOR_RGB2BGR)
-    cv2.imshow('Scaled Painting', scaled_img_cv2)
-    cv2.waitKey(0)
-    cv2.destroyAllWindows()
+def planning_parameters():
+    """Planning constants a plan depends on, as recorded in saved plans"""
+    return {
+        'num_colors': NUM_COLORS,
+        'stroke_size': STROKE_SIZE,
+        'resolution': RESOLUTION,
+        'canvas_dim': [CANVAS_DIM_X, CANVAS_DIM_Y],
+        'brush_width_pixels': BRUSH_WIDTH_PIXELS,
+        'paint_per_dip': PAINT_PER_DIP,
+    }
 
-    print(f'num strokes: {len(start_end_points)}')
-    return physical_coords, colors
+def strokes_hash(strokes):
+    """SHA-256 of a stroke array"""
+    return hashlib.sha256(np.ascontiguousarray(strokes, dtype=np.int64).tobytes()).hexdigest()
+
+def plan_hash(parameters, strokes=None):
+    """SHA-256 identifying a plan by its planning parameters and, when known, its strokes"""
+    digest = hashlib.sha256(json.dumps(parameters, sort_keys=True).encode())
+    if strokes is not None:
+        digest.update(strokes_hash(strokes).encode())
+    return digest.hexdigest()
+
+def save_plan(path, plan):
+    """Write a plan from plan_painting to a versioned .npz file
+
+    The file holds the palette, strokes in pixel and robot coordinates, the dip
+    schedule, the canvas transform and a JSON metadata record (format version,
+    source image hash and the planning constants). Previews are not saved.
+    """
+    transform = plan['canvas_transform']
+    metadata = {
+        'version': PLAN_FORMAT_VERSION,
+        'image_hash': plan.get('image_hash'),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        **planning_parameters(),
+    }
+    # Write under a temporary name so a crash never leaves a truncated plan behind
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f,
+                 metadata=np.array(json.dumps(metadata)),
+                 colors=np.asarray(plan['colors'], dtype=np.int64).reshape(-1, 3),
+                 strokes=np.ascontiguousarray(plan['strokes'], dtype=np.int64),
+                 physical_coords=np.ascontiguousarray(plan['physical_coords'], dtype=np.float64),
+                 dips=np.asarray(plan['dips'], dtype=bool),
+                 homography=transform['homography'],
+                 z_plane=transform['z_plane'],
+                 orientation=transform['orientation'])
+    os.replace(tmp_path, path)
+
+def load_plan(path):
+    """Read a plan written by save_plan
+
+    Returns the same dict as plan_painting, plus 'metadata', without
+    'output_image' or 'preview'. Raises ValueError for other format versions.
+    """
+    with np.load(path, allow_pickle=False) as data:
+        metadata = json.loads(str(data['metadata']))
+        if metadata.get('version') != PLAN_FORMAT_VERSION:
+            raise ValueError(f'{path}: plan format version {metadata.get("version")}, expected {PLAN_FORMAT_VERSION}')
+
+        plan = {
+            'strokes': data['strokes'],
+            'physical_coords': data['physical_coords'],
+            'colors': [tuple(int(c) for c in color) for color in data['colors']],
+            'dips': data['dips'],
+            'image_hash': metadata['image_hash'],
+            'canvas_transform': {
+                'homography': data['homography'],
+                'z_plane': data['z_plane'],
+                'orientation': data['orientation'],
+            },
+            'metadata': metadata,
+            'output_image': None,
+            'preview': None,
+        }
+
+    print(f'loaded plan {path}: {len(plan["strokes"])} strokes, created {metadata["created"]}')
+    return plan
+
+class ProgressJournal:
+    """Append-only record of the strokes an execution has completed
+
+    The first line names the plan_hash of the plan being painted. Every batch
+    adds a "batch <offset> <strokes hash>" line before its first record, and
+    every record is "<stroke index> <color id> <paint left>" for the last
+    stroke of a finished trajectory, stroke indices counting over the whole
+    plan. Records are flushed and fsync'd every sync_every records and on
+    close, so a crash loses at most that many trajectories, which are then
+    painted again.
+
+    Resuming raises ValueError when the plan or one of its batches differs
+    from the journaled one, since stroke indices would then point at other
+    strokes.
+    """
+
+    def __init__(self, path, plan_id, resume=False, sync_every=JOURNAL_SYNC_EVERY):
+        self.path = path
+        self.sync_every = sync_every
+        self.completed = -1 # index of the last completed stroke
+        self.color = None
+        self.paint_left = None
+        self.batches = {} # batch offset -> strokes_hash
+        self.unsynced = 0
+
+        if resume and os.path.exists(path):
+            with open(path) as f:
+                text = f.read()
+            lines = text.split('\n')
+            if lines[0] != f'plan {plan_id}':
+                raise ValueError(f'{path}: journal was written for another plan')
+            # The last line is partial if the crash happened while writing it
+            for line in lines[1:]:
+                fields = line.split()
+                if len(fields) != 3:
+                    continue
+                if fields[0] == 'batch':
+                    if len(fields[2]) == 64:
+                        self.batches[int(fields[1])] = fields[2]
+                    continue
+                self.completed, self.color, self.paint_left = int(fields[0]), int(fields[1]), float(fields[2])
+            self.file = open(path, 'a')
+            if not text.endswith('\n'):
+                self.file.write('\n')
+            print(f'resuming after stroke {self.completed}')
+        else:
+            self.file = open(path, 'w')
+            self.file.write(f'plan {plan_id}\n')
+            self.sync()
+
+    def start_batch(self, offset, strokes):
+        """Journal the strokes of the batch starting at plan index offset
+
+        Raises ValueError if a batch journaled at this offset had other strokes.
+        """
+        digest = strokes_hash(strokes)
+        journaled = self.batches.get(offset)
+        if journaled is None:
+            self.file.write(f'batch {offset} {digest}\n')
+            self.batches[offset] = digest
+        elif journaled != digest:
+            raise ValueError(f'{self.path}: batch at stroke {offset} differs from the journaled plan')
+
+    def record(self, stroke_index, color_id, paint_left):
+        self.file.write(f'{stroke_index} {color_id} {paint_left:.4f}\n')
+        self.completed, self.color, self.paint_left = stroke_index, color_id, paint_left
+        self.unsynced += 1
+        if self.unsynced >= self.sync_every:
+            self.sync()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+
+    def close(self):
+        if not self.file.closed:
+            self.sync()
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def iter_plan_batches(image_path, ROBOT_ORIGIN, batch_size=STREAM_BATCH_STROKES, use_cache=False, quantizer=QUANTIZER, orientations=STROKE_ORIENTATIONS):
+    """Plan a painting lazily, yielding strokes as soon as they are ready
+
+    Arguments are those of plan_painting, plus batch_size, the largest number of
+    strokes per batch.
+
+    The image is quantized once, then each color is extracted, ordered and
+    dip-scheduled on its own and yielded in batches of at most batch_size
+    strokes. Every batch is a dict with the 'colors' palette, its 'strokes',
+    'physical_coords' and 'dips'. Ordering continues from where the previous
+    batch left the brush.
+    """
+    resized_image = preprocessing(image_path)
+
+    if use_cache:
+        labels, centers = cached_quantize(resized_image, method=quantizer)
+    else:
+        labels, centers = quantize_colors(resized_image, method=quantizer)
+    colors = palette_colors(centers)
+    label_image = np.asarray(labels).reshape(resized_image.shape[:2])
+
+    # Runs and regions of every color are found in one pass over the image
+    candidates = stroke_candidates(label_image, orientations)
+    position = (0, 0)
+    for color_id in np.unique(label_image):
+        strokes = extract_strokes(label_image, orientations, color_ids=[color_id], verbose=False, candidates=candidates)
+        strokes = optimize_stroke_order(strokes, start_point=position, verbose=False)
+        strokes, dips = schedule_dips(strokes, verbose=False)
+        if len(strokes) > 0:
+            position = stroke_endpoints(strokes[-1:])[1][0]
+
+        print(f'color {color_id}: {len(strokes)} strokes planned')
+        for start in range(0, len(strokes), batch_size):
+            batch = strokes[start:start + batch_size]
+            yield {
+                'colors': colors,
+                'strokes': batch,
+                'physical_coords': pixel_to_physical_coords(batch, ROBOT_ORIGIN),
+                'dips': dips[start:start + batch_size],
+            }
+
+def prefetch(iterable, maxsize=STREAM_QUEUE_SIZE):
+    """Run an iterable on a background thread, handing items over through a bounded queue
+
+    The producer starts right away, so planning overlaps whatever the caller
+    does before reading the first item. It blocks once maxsize items are
+    waiting, so planning never runs far ahead of execution. An exception
+    raised by the producer is re-raised in the consumer.
+    """
+    items = queue.Queue(maxsize)
+    done = object()
+    failure = []
+    stop = threading.Event()
+
+    def put(item):
+        # Give up once the consumer has stopped reading
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except BaseException as e:
+            failure.append(e)
+        put(done)
+
+    def consume():
+        try:
+            while True:
+                item = items.get()
+                if item is done:
+                    break
+                yield item
+        finally:
+            stop.set()
+
+        if failure:
+            raise failure[0]
+
+    threading.Thread(target=produce, daemon=True).start()
+    return consume()
+
+def painting(image_path, save_path, ROBOT_ORIGIN, show=True, use_cache=False):
+
+    plan = plan_painting(image_path, ROBOT_ORIGIN, preview_scale=PREVIEW_SCALE if show else None, use_cache=use_cache, show=show)
+
+    if save_path:
+        cv2.imwrite(save_path, plan['output_image'])
+
+    # Display painting
+    if show:
+        cv2.imshow('Scaled Painting', plan['preview'])
+        cv2.waitKey(0)
+        cv2.destroyAllWindows()
+
+    return plan
 
 def main():
     image_path = 'stanford_logo.png'
     save_path = 'stanford_painting.png'
     ROBOT_ORIGIN = (0.48, -.117, .177, 90, 0, 90) # TODO CHANGE
-    physical_coords = painting(image_path, save_path, ROBOT_ORIGIN)
+    plan = painting(image_path, save_path, ROBOT_ORIGIN)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,36 @@
+#! /usr/bin/env python3
+
+# Preview a painting plan without the arm: render the strokes with the brush
+# footprint and optionally export a video timed by the execution estimate.
+#
+# usage: python3 plan_preview.py plan.npz [--scale N] [--animation out.mp4] [--speedup S]
+
+import argparse
+
+import cv2
+
+from painting_utils import *
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('plan', help='plan saved with painting.py --save-plan')
+    parser.add_argument('--scale', type=int, default=PREVIEW_SCALE)
+    parser.add_argument('--animation', type=str, help='write a video of the plan being painted')
+    parser.add_argument('--speedup', type=float, default=ANIMATION_SPEEDUP, help='seconds of execution per second of video')
+    parser.add_argument('--no-show', action='store_true', help='do not open a preview window')
+    args = parser.parse_args()
+
+    plan = load_plan(args.plan)
+    print(f'estimated time: {estimate_plan_time(plan["strokes"], dips=plan["dips"]):.0f} s')
+
+    if args.animation:
+        export_plan_animation(args.animation, plan, args.scale, speedup=args.speedup)
+        print(f'wrote {args.animation}')
+
+    if not args.no_show:
+        cv2.imshow('Plan preview', render_strokes(plan['strokes'], plan['colors'], scale=args.scale))
+        cv2.waitKey(0)
+        cv2.destroyAllWindows()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+#! /usr/bin/env python3
+
+# Compare the color quantizer backends of painting_utils on speed and color fidelity.
+#
+# usage: python3 quantizer_benchmark.py [image ...] [--colors N] [--size WxH]
+
+import argparse
+import time
+
+import cv2
+import numpy as np
+
+from painting_utils import QUANTIZERS, NUM_COLORS, palette_error
+
+def synthetic_image(width, height, num_colors=NUM_COLORS, seed=0):
+    """Flat color blobs over a gradient, with a little noise, as a float image"""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width] / max(width, height)
+    image = np.dstack((x, y, 1 - x)).astype(np.float32)
+    for color in rng.random((num_colors, 3)):
+        cx, cy = rng.random(2)
+        radius = rng.uniform(0.1, 0.3)
+        image[(x - cx) ** 2 + (y - cy) ** 2 < radius ** 2] = color
+    image += rng.normal(0, 0.02, image.shape).astype(np.float32)
+    return np.clip(image, 0, 1)
+
+def load_image(path, width, height):
+    image = cv2.imread(path)
+    if image is None:
+        raise FileNotFoundError(path)
+    return cv2.resize(image.astype(np.float32) / 255.0, (width, height))
+
+def benchmark(name, image, num_colors):
+    pixels = image.reshape((-1, image.shape[2]))
+    print(f'\n{name}: {image.shape[1]}x{image.shape[0]}, {num_colors} colors')
+    print(f'{"backend":<12}{"time (ms)":>12}{"rms error":>12}{"colors":>8}')
+    for method, quantizer in QUANTIZERS.items():
+        start = time.perf_counter()
+        labels, centers = quantizer(pixels, num_colors)
+        elapsed = (time.perf_counter() - start) * 1000
+        print(f'{method:<12}{elapsed:>12.1f}{palette_error(pixels, labels, centers):>12.2f}{len(centers):>8}')
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('images', nargs='*', default=['stanford_logo.png', 'cherries.jpeg'])
+    parser.add_argument('--colors', type=int, default=NUM_COLORS)
+    parser.add_argument('--size', type=str, default='512x384', help='resolution images are resized to')
+    args = parser.parse_args()
+    width, height = (int(v) for v in args.size.split('x'))
+
+    benchmark('synthetic', synthetic_image(width, height, args.colors), args.colors)
+    for path in args.images:
+        benchmark(path, load_image(path, width, height), args.colors)
+
+if __name__ == '__main__':
+    main()
@@ -4,6 +4,11 @@ import sys
 import os
 import time
 import threading
+from motion_timing import estimate_motion_time, load_limits
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import utilities
+
 from kortex_api.autogen.client_stubs.BaseClientRpc import BaseClient
 from kortex_api.autogen.client_stubs.BaseCyclicClientRpc import BaseCyclicClient
 from kortex_api.autogen.messages import Base_pb2, BaseCyclic_pb2, Common_pb2
@@ -63,11 +68,12 @@ def example_angular_action_movement(base):
     action.name = "Example angular action movement"
     action.application_data = ""
 
-    actuator_count = base.GetActuatorCount()
+    # Read once per session
+    actuator_count = utilities.device_metadata(base.router).actuator_count
 
     # Place arm straight up
     joint_angles = [357, 37, 172, 238, 350, 70, 0]
-    for joint_id in range(actuator_count.count):
+    for joint_id in range(actuator_count):
         joint_angle = action.reach_joint_angles.joint_angles.joint_angles.add()
         joint_angle.joint_identifier = joint_id
         joint_angle.value = joint_angles[joint_id]
@@ -92,8 +98,6 @@ def example_angular_action_movement(base):
     return finished
 
 def main():
-    sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
-    import utilities
     args = utilities.parseConnectionArguments()
     with utilities.DeviceConnection.createTcpConnection(args) as router:
         base = BaseClient(router)
@@ -110,6 +114,10 @@ def main():
                     (0.7,   0.48, 0.33, 0.1, kTheta_x, kTheta_y, kTheta_z),
                     (0.63, -0.22, 0.45, 0.1, kTheta_x, kTheta_y, kTheta_z),
                     (0.65,  0.05, 0.33, 0.0, kTheta_x, kTheta_y, kTheta_z))
+        joint_angles = [357, 37, 172, 238, 350, 70, 0] # example_angular_action_movement
+        _, total = estimate_motion_time([('waypoints', waypoints), ('joint', joint_angles)], start_joints=None, limits=load_limits())
+        print('estimated duration: {:.1f} s'.format(total))
+
         success &= execute_waypoint_trajectory(base, waypoints)
 
         print('rotating joint')
@@ -0,0 +1,166 @@
+import math
+import os
+import tempfile
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from painting_utils import *
+
+# Tiled planning
+TILE_ROWS = 256 # canvas rows resized, labelled and scanned at once
+
+def open_source(image_path):
+    """Return a (rows, cols, 3) uint8 BGR array of the source image
+
+    Only .npy files (saved from cv2.imread, so BGR, or by convert_source) are
+    memory-mapped and never loaded whole; memory then stays bounded by the
+    tile size. Other formats are decoded whole through PIL at 8 bits per
+    channel, JPEGs at the smallest DCT scale that still covers the canvas
+    resolution.
+    """
+    if image_path.endswith('.npy'):
+        return np.load(image_path, mmap_mode='r')
+
+    print(f'{image_path} is decoded whole; convert it with convert_source to bound memory')
+    image = Image.open(image_path)
+    image.draft('RGB', (int(RESOLUTION * CANVAS_DIM_Y), int(RESOLUTION * CANVAS_DIM_X)))
+    return np.asarray(image.convert('RGB'))[:, :, ::-1]
+
+def convert_source(image_path, npy_path):
+    """Save an image as the memory-mappable .npy source open_source reads lazily
+
+    The image is decoded whole once, e.g. on a machine with enough memory.
+    """
+    image = Image.open(image_path).convert('RGB')
+    source = np.lib.format.open_memmap(npy_path, mode='w+', dtype=np.uint8, shape=(image.height, image.width, 3))
+    source[:] = np.asarray(image)[:, :, ::-1]
+    source.flush()
+
+def resize_strips(source, tile_rows=TILE_ROWS):
+    """Yield (y0, strip) float32 canvas strips resized from the source
+
+    Same orientation rule as preprocessing; rotating a memory-mapped source is
+    a view, and only one source band is copied at a time.
+    """
+    rows, cols = canvas_size()
+    is_img_landscape = source.shape[0] <= source.shape[1]
+    is_canvas_landscape = CANVAS_DIM_X <= CANVAS_DIM_Y
+    if is_img_landscape ^ is_canvas_landscape:
+        source = np.rot90(source)
+
+    scale = source.shape[0] / rows
+    for y0 in range(0, rows, tile_rows):
+        y1 = min(rows, y0 + tile_rows)
+        band = source[int(math.floor(y0 * scale)):max(int(math.ceil(y1 * scale)), int(math.floor(y0 * scale)) + 1)]
+        band = np.ascontiguousarray(band).astype(np.float32) / 255.0
+        yield y0, cv2.resize(band, (cols, y1 - y0), interpolation=cv2.INTER_AREA)
+
+def find_vertical_runs_tiled(label_image, tile_rows=TILE_ROWS):
+    """find_vertical_runs over a (possibly memory-mapped) label image, one strip at a time
+
+    Runs reaching the bottom of a strip stay open and are joined with the run
+    that starts the same column of the next strip when it has the same color.
+    """
+    rows, cols = label_image.shape
+    open_start = np.zeros(cols, dtype=np.int64)
+    open_color = np.full(cols, -1, dtype=np.int64)
+    strokes = []
+
+    for y0 in range(0, rows, tile_rows):
+        y1 = min(rows, y0 + tile_rows)
+        runs = find_vertical_runs(np.asarray(label_image[y0:y1]))
+        runs[:, STROKE_Y_START] += y0
+        runs[:, STROKE_Y_END] += y0
+
+        x = runs[:, STROKE_X]
+        continued = (runs[:, STROKE_Y_START] == y0) & (open_color[x] == runs[:, STROKE_COLOR])
+        runs[continued, STROKE_Y_START] = open_start[x[continued]]
+        runs[:, STROKE_LENGTH] = runs[:, STROKE_Y_END] - runs[:, STROKE_Y_START] + 1
+
+        # Open runs that the new strip does not continue end at the border
+        closed = open_color >= 0
+        closed[x[continued]] = False
+        closed_x = np.nonzero(closed)[0]
+        ended = np.empty((len(closed_x), 6), dtype=np.int64)
+        ended[:, STROKE_X] = closed_x
+        ended[:, STROKE_X_END] = closed_x
+        ended[:, STROKE_Y_START] = open_start[closed_x]
+        ended[:, STROKE_Y_END] = y0 - 1
+        ended[:, STROKE_COLOR] = open_color[closed_x]
+        ended[:, STROKE_LENGTH] = y0 - open_start[closed_x]
+        strokes.append(ended)
+
+        # Every column has exactly one run touching the bottom of the strip
+        at_bottom = runs[:, STROKE_Y_END] == y1 - 1
+        if y1 < rows:
+            open_start[x[at_bottom]] = runs[at_bottom, STROKE_Y_START]
+            open_color[x[at_bottom]] = runs[at_bottom, STROKE_COLOR]
+            runs = runs[~at_bottom]
+        strokes.append(runs)
+
+    strokes = np.vstack(strokes)
+    return strokes[np.lexsort((strokes[:, STROKE_Y_START], strokes[:, STROKE_X], strokes[:, STROKE_COLOR]))]
+
+def plan_painting_tiled(image_path, ROBOT_ORIGIN, tile_rows=TILE_ROWS, quantizer=QUANTIZER, sample_size=QUANTIZER_SAMPLE_SIZE):
+    """plan_painting with memory bounded by the tile size instead of the image size
+
+    Arguments:
+    image_path -- source image; only .npy sources are memory-mapped, see open_source
+    ROBOT_ORIGIN -- robot pose of the canvas origin, or a canvas transform
+    tile_rows -- canvas rows processed at once
+    quantizer -- key of QUANTIZERS fitted on the sample
+    sample_size -- number of canvas pixels the palette is fitted on
+
+    The bound holds for .npy sources (see convert_source); other formats are
+    decoded whole before the strips are resized. The resized canvas and its
+    labels live in memory-mapped scratch files.
+    The palette is fitted on a random sample drawn evenly from every strip,
+    pixels are labelled strip by strip against it and vertical runs are
+    stitched across strip borders. Only vertical strokes are produced, since
+    the other patterns of extract_strokes need the whole image at once.
+
+    Returns the same dict as plan_painting, without 'output_image' or 'preview'.
+    """
+    source = open_source(image_path)
+    rows, cols = canvas_size()
+    rng = np.random.default_rng(42)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        canvas = np.lib.format.open_memmap(os.path.join(workdir, 'canvas.npy'), mode='w+', dtype=np.float32, shape=(rows, cols, 3))
+        samples = []
+        for y0, strip in resize_strips(source, tile_rows):
+            canvas[y0:y0 + len(strip)] = strip
+            pixels = strip.reshape((-1, 3))
+            count = min(len(pixels), int(math.ceil(sample_size * len(strip) / rows)))
+            samples.append(pixels[rng.choice(len(pixels), count, replace=False)])
+
+        _, centers = QUANTIZERS[quantizer](np.vstack(samples), NUM_COLORS)
+        for i, color in enumerate(centers):
+            print(f'Color {i + 1}: {color*255}')
+
+        label_image = np.lib.format.open_memmap(os.path.join(workdir, 'labels.npy'), mode='w+', dtype=np.uint8, shape=(rows, cols))
+        for y0 in range(0, rows, tile_rows):
+            strip = np.asarray(canvas[y0:y0 + tile_rows])
+            label_image[y0:y0 + len(strip)] = nearest_center(strip.reshape((-1, 3)), centers).reshape(strip.shape[:2])
+
+        strokes = find_vertical_runs_tiled(label_image, tile_rows)
+        del canvas, label_image
+
+    strokes = merge_strokes(strokes, None, verbose=False)
+    strokes = optimize_stroke_order(strokes)
+    strokes, dips = schedule_dips(strokes)
+
+    palette = (np.asarray(centers) * 255).astype(np.int64)
+    print(f'num strokes: {len(strokes)}')
+    return {
+        'strokes': strokes,
+        'physical_coords': pixel_to_physical_coords(strokes, ROBOT_ORIGIN),
+        'colors': [tuple(int(c) for c in color) for color in palette],
+        'dips': dips,
+        'image_hash': file_hash(image_path),
+        'canvas_transform': canvas_transform(ROBOT_ORIGIN),
+        'output_image': None,
+        'preview': None,
+    }
@@ -1,4 +1,6 @@
 import argparse
+import threading
+import weakref
 
 from kortex_api.TCPTransport import TCPTransport
 from kortex_api.UDPTransport import UDPTransport
@@ -12,6 +14,110 @@ def parseConnectionArguments(parser = argparse.ArgumentParser()):
     parser.add_argument("-p", "--password", type=str, help="password to login", default="admin")
     return parser.parse_args()
 
+class SessionRegistry:
+    """
+    One helper object per API client (BaseClient, RouterClient...), created by
+    factory(client, *args) on first use
+
+    Keyed weakly by the client itself, so a new client never gets the object of
+    a released one; objects that hold their client stay until pop or discard.
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.lock = threading.Lock()
+        self.objects = weakref.WeakKeyDictionary()
+
+    def get(self, client, *args):
+        with self.lock:
+            obj = self.objects.get(client)
+            if obj is None:
+                obj = self.objects[client] = self.factory(client, *args)
+            return obj
+
+    def find(self, client):
+        """The object of a client, or None if it was never created"""
+        with self.lock:
+            return self.objects.get(client)
+
+    def pop(self, client):
+        """Forget and return the object of a client, if any"""
+        with self.lock:
+            return self.objects.pop(client, None)
+
+    def discard(self, client, obj):
+        """Forget the object of a client if it still is obj"""
+        with self.lock:
+            if self.objects.get(client) is obj:
+                del self.objects[client]
+
+class DeviceMetadata:
+    """
+    Facts about the device that do not change during a session, each fetched
+    with one request on first use and kept until the connection is closed.
+    """
+
+    def __init__(self, router):
+        self.router = router
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def _memoize(self, key, fetch):
+        with self.lock:
+            if key in self.values:
+                return self.values[key]
+        value = fetch()
+        with self.lock:
+            return self.values.setdefault(key, value)
+
+    @property
+    def actuator_count(self):
+        from kortex_api.autogen.client_stubs.BaseClientRpc import BaseClient
+        return self._memoize('actuator_count', lambda: BaseClient(self.router).GetActuatorCount().count)
+
+    @property
+    def product_configuration(self):
+        from kortex_api.autogen.client_stubs.BaseClientRpc import BaseClient
+        return self._memoize('product_configuration', lambda: BaseClient(self.router).GetProductConfiguration())
+
+    @property
+    def model(self):
+        return self.product_configuration.model
+
+    @property
+    def devices_by_type(self):
+        """device type -> list of device handles, in ReadAllDevices order"""
+        from kortex_api.autogen.client_stubs.DeviceManagerClientRpc import DeviceManagerClient
+        def fetch():
+            devices = {}
+            for device in DeviceManagerClient(self.router).ReadAllDevices().device_handle:
+                devices.setdefault(device.device_type, []).append(device)
+            return devices
+        return self._memoize('devices_by_type', fetch)
+
+    def device_id(self, device_type, device_index=0):
+        """Identifier of the device_index-th device of a type, or None"""
+        devices = self.devices_by_type.get(device_type, [])
+        return devices[device_index].device_identifier if device_index < len(devices) else None
+
+    def firmware_version(self, device_id=None):
+        """Firmware version of a device (the base when device_id is None)"""
+        from kortex_api.autogen.client_stubs.DeviceConfigClientRpc import DeviceConfigClient
+        def fetch():
+            device_config = DeviceConfigClient(self.router)
+            if device_id is None:
+                return device_config.GetFirmwareVersion().firmware_version
+            return device_config.GetFirmwareVersion(deviceId=device_id).firmware_version
+        return self._memoize(('firmware_version', device_id), fetch)
+
+_metadata = SessionRegistry(DeviceMetadata)
+
+def device_metadata(router):
+    """
+    returns the DeviceMetadata of the session a RouterClient belongs to
+    """
+    return _metadata.get(router)
+
 class DeviceConnection:
     
     TCP_PORT = 10000
@@ -44,6 +150,7 @@ class DeviceConnection:
         # Setup API
         self.transport = TCPTransport() if port == DeviceConnection.TCP_PORT else UDPTransport()
         self.router = RouterClient(self.transport, RouterClient.basicErrorCallback)
+        self.metadata = device_metadata(self.router)
 
     # Called when entering 'with' statement
     def __enter__(self):
@@ -73,4 +180,5 @@ class DeviceConnection:
             
             self.sessionManager.CloseSession(router_options)
 
+        _metadata.pop(self.router)
         self.transport.disconnect()